@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Untappd refresh benchmark.
+
+Crawls a beer list from the fake Untappd site with different numbers of parsing processes and reports the refresh
+wall time next to the number of available cores. A ticker thread runs alongside the crawl to show how long the
+crawling process' other threads (the bot's, in production) have to wait for the GIL. The fake site runs in its own
+process so serving pages does not compete with the crawler for the GIL.
+
+With --schedule it instead checks that the crawl scheduler spreads the refreshes of several lists evenly over the
+refresh interval instead of crawling them back-to-back.
+
+Usage:
+    python3 CrawlBench.py --beers 60 --workers 0 1 2 4
+    python3 CrawlBench.py --schedule 4
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import statistics
+import sys
+import threading
+import time
+from typing import Dict, List
+
+from FakeBackends import FakeUntappd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "src"))
+
+
+class Ticker:
+    """
+    Wakes up at a fixed interval and records how late it was
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lateness: List[float] = []
+        self.running = False
+        self.thread = None
+
+    def run(self):
+        while self.running:
+            start = time.perf_counter()
+            time.sleep(self.interval)
+            self.lateness.append(time.perf_counter() - start - self.interval)
+
+    def __enter__(self):
+        self.lateness = []
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.running = False
+        self.thread.join()
+        return False
+
+
+def serve_untappd(beers: int, delay: float, urls, stop):
+    untappd = FakeUntappd(beers=beers, delay=delay)
+    untappd.start()
+    urls.put(untappd.list_url())
+    stop.wait()
+    untappd.stop()
+
+
+def measure(list_url: str, beers: int, workers: int, repeat: int) -> Dict:
+    from UntappdUtils import UntappdCrawler
+
+    crawler = UntappdCrawler(use_proxy=False, parse_workers=workers)
+    crawler.set_beer_lists({"bench": list_url})
+    try:
+        # Starts the parsing processes
+        crawler.get_beers_on_list("bench")
+
+        times = []
+        lateness = []
+        for _ in range(repeat):
+            with Ticker() as ticker:
+                start = time.perf_counter()
+                result = crawler.get_beers_on_list("bench")
+                times.append(time.perf_counter() - start)
+            lateness.extend(ticker.lateness)
+            if result is None or len(result) != beers:
+                raise RuntimeError("Crawl returned {} beers, expected {}".format(
+                    None if result is None else len(result), beers))
+    finally:
+        crawler.shutdown()
+
+    lateness.sort()
+    return {"workers": workers,
+            "refresh_s": statistics.median(times),
+            "refresh_min_s": min(times),
+            "tick_p99_ms": lateness[int(0.99 * (len(lateness) - 1))] * 1000 if lateness else float("nan"),
+            "tick_max_ms": lateness[-1] * 1000 if lateness else float("nan")}
+
+
+def check_schedule(lists: int, interval=1.0, cycles=3) -> bool:
+    """
+    Runs the crawl scheduler with instant refreshes and a fixed delay, and checks the spread of the refresh times
+    :param lists: Number of lists
+    :param interval: Refresh interval in seconds
+    :param cycles: Refresh cycles to run after the first pass
+    :return: True if consecutive refreshes after the first pass are about interval / lists apart
+    """
+    from UntappdUtils import CrawlScheduler
+
+    times = []
+    scheduler = CrawlScheduler(lambda list: interval, lambda list: times.append(time.perf_counter()))
+    thread = threading.Thread(target=scheduler.run, args=(["list{}".format(i) for i in range(lists)],), daemon=True)
+    thread.start()
+    time.sleep(interval * (cycles + 1))
+    scheduler.stop()
+    thread.join()
+
+    gaps = [b - a for a, b in zip(times[lists:], times[lists + 1:])]
+    expected = interval / lists
+    ok = bool(gaps) and min(gaps) > expected / 2
+    print("lists: {}, interval: {} s, expected gap: {:.3f} s, gaps: {}".format(
+        lists, interval, expected, " ".join("{:.3f}".format(gap) for gap in gaps)))
+    print("OK" if ok else "FAILED: refreshes are not spread over the interval")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--beers", type=int, default=60, help="beers on the fake menu")
+    parser.add_argument("--untappd-delay", type=float, default=0.0, help="fake Untappd page latency in seconds")
+    parser.add_argument("--workers", type=int, nargs="+",
+                        help="parsing process counts to measure, 0 parses on the fetching threads "
+                             "(default: 0 up to the core count)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed refreshes per worker count")
+    parser.add_argument("--results-dir", help="directory to store the result JSON in")
+    parser.add_argument("--schedule", type=int, metavar="LISTS",
+                        help="check the refresh spread of the crawl scheduler with this many lists instead")
+    args = parser.parse_args()
+
+    if args.schedule:
+        sys.exit(0 if check_schedule(args.schedule) else 1)
+
+    cores = os.cpu_count() or 1
+    workers = args.workers if args.workers else list(range(0, cores + 1))
+
+    mp = multiprocessing.get_context("spawn")
+    urls = mp.Queue()
+    stop = mp.Event()
+    server = mp.Process(target=serve_untappd, args=(args.beers, args.untappd_delay, urls, stop), daemon=True)
+    server.start()
+    try:
+        list_url = urls.get(timeout=30)
+        rows = [measure(list_url, args.beers, n, args.repeat) for n in workers]
+    finally:
+        stop.set()
+        server.join(5)
+
+    print("cores: {}, beers: {}".format(cores, args.beers))
+    print("{:<10}{:>14}{:>14}{:>14}{:>14}".format("workers", "refresh s", "min s", "tick p99 ms", "tick max ms"))
+    for row in rows:
+        print("{:<10}{:>14.3f}{:>14.3f}{:>14.2f}{:>14.2f}".format(row["workers"], row["refresh_s"],
+                                                                  row["refresh_min_s"], row["tick_p99_ms"],
+                                                                  row["tick_max_ms"]))
+
+    if args.results_dir:
+        os.makedirs(args.results_dir, exist_ok=True)
+        path = os.path.join(args.results_dir, "{}-crawl.json".format(time.strftime("%Y-%m-%dT%H%M%S")))
+        with open(path, "w") as f:
+            json.dump({"cores": cores, "beers": args.beers, "untappd_delay": args.untappd_delay,
+                       "rows": rows}, f, indent=2)
+        print("Result stored in " + path)
+
+
+if __name__ == "__main__":
+    main()
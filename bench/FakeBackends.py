@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Local stand-ins for the external services the bot talks to:
+a fake Telegram bot API, a fake Untappd site serving fixture pages and a synthetic camera source.
+"""
+
+import json
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+from urllib.parse import parse_qs, urlparse
+
+
+class FakeTelegram:
+    """
+    Minimal Telegram bot API implementing getUpdates, sendMessage, sendPhoto, sendMediaGroup, sendDocument and
+    answerInlineQuery.
+    Injected messages and inline queries are served as updates, replies are matched back to them by
+    reply_to_message_id or inline_query_id.
+    """
+
+    def __init__(self, port=0):
+        self.lock = threading.Lock()
+        self.updates: List[Dict] = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        # message_id -> injection time
+        self.sent_at: Dict[int, float] = {}
+        # message_id -> time of the first reply
+        self.replied_at: Dict[int, float] = {}
+        self.replies = 0
+        # Photos uploaded in media groups
+        self.uploads = 0
+        # message_id -> content of the last document sent in reply to it
+        self.documents: Dict[int, bytes] = {}
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}/bot".format(self.server.server_address[1])
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def inject(self, text: str, user_id=1, username="bench", chat_id=-1) -> int:
+        """
+        Queues an incoming text message
+        :param text: Message text
+        :param user_id: Sender id
+        :param username: Sender username
+        :param chat_id: Chat id
+        :return: Message id
+        """
+        with self.lock:
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.updates.append({"update_id": self.next_update_id,
+                                 "message": {"message_id": message_id,
+                                             "from": {"id": user_id, "username": username},
+                                             "chat": {"id": chat_id},
+                                             "date": int(time.time()),
+                                             "text": text}})
+            self.next_update_id += 1
+            self.sent_at[message_id] = time.perf_counter()
+        return message_id
+
+    def inject_inline(self, query: str, user_id=1, username="bench") -> int:
+        """
+        Queues an incoming inline query. Inline queries share the message id sequence, so they are tracked the
+        same way as messages.
+        :param query: Query text
+        :param user_id: Sender id
+        :param username: Sender username
+        :return: Inline query id
+        """
+        with self.lock:
+            query_id = self.next_message_id
+            self.next_message_id += 1
+            self.updates.append({"update_id": self.next_update_id,
+                                 "inline_query": {"id": str(query_id),
+                                                  "from": {"id": user_id, "username": username},
+                                                  "query": query,
+                                                  "offset": ""}})
+            self.next_update_id += 1
+            self.sent_at[query_id] = time.perf_counter()
+        return query_id
+
+    def _answer_inline_query(self, params):
+        now = time.perf_counter()
+        json.loads(params["results"])
+        with self.lock:
+            self.replies += 1
+            self.replied_at.setdefault(int(params["inline_query_id"]), now)
+        return True
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset", 0) or 0)
+        with self.lock:
+            self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            return list(self.updates)
+
+    def _reply(self, method, params):
+        now = time.perf_counter()
+        with self.lock:
+            self.replies += 1
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            reply_to = params.get("reply_to_message_id")
+            if reply_to:
+                self.replied_at.setdefault(int(reply_to), now)
+        result = {"message_id": message_id, "chat": {"id": int(params.get("chat_id", 0) or 0)}}
+        if method == "sendPhoto":
+            result["photo"] = [{"file_id": "bench-photo-{}".format(message_id)}]
+        if method == "sendDocument" and reply_to:
+            document = params["files"]["document"]
+            with self.lock:
+                self.documents[int(reply_to)] = document if isinstance(document, bytes) else document.encode()
+        if method == "sendMediaGroup":
+            results = []
+            for i, item in enumerate(json.loads(params["media"])):
+                file_id = item["media"]
+                if file_id.startswith("attach://"):
+                    file_id = "bench-photo-{}-{}".format(message_id, i)
+                    with self.lock:
+                        self.uploads += 1
+                results.append(dict(result, photo=[{"file_id": file_id}]))
+            return results
+        return result
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _params(self):
+                params = {k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()}
+                length = int(self.headers.get("Content-Length", 0))
+                if length == 0:
+                    return params
+                body = self.rfile.read(length)
+                content_type = self.headers.get("Content-Type", "")
+                if content_type.startswith("multipart/form-data"):
+                    msg = BytesParser(policy=HTTP).parsebytes(
+                        b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+                    for part in msg.iter_parts():
+                        name = part.get_param("name", header="content-disposition")
+                        if part.get_filename() is None:
+                            params[name] = part.get_content()
+                        else:
+                            params.setdefault("files", {})[name] = part.get_content()
+                else:
+                    params.update({k: v[0] for k, v in parse_qs(body.decode()).items()})
+                return params
+
+            def _respond(self, result):
+                body = json.dumps({"ok": True, "result": result}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _dispatch(self):
+                method = urlparse(self.path).path.rsplit("/", 1)[-1]
+                params = self._params()
+                if method == "getUpdates":
+                    self._respond(fake._get_updates(params))
+                elif method in ("sendMessage", "sendPhoto", "sendMediaGroup", "sendDocument"):
+                    self._respond(fake._reply(method, params))
+                elif method == "answerInlineQuery":
+                    self._respond(fake._answer_inline_query(params))
+                else:
+                    self.send_error(404)
+
+            do_GET = _dispatch
+            do_POST = _dispatch
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+MENU_TEMPLATE = """<html><body><div class="menu"><ul class="menu-section-list">{}</ul></div></body></html>"""
+MENU_ITEM_TEMPLATE = """<li><a href="/b/{slug}/{id}">{name}</a></li>"""
+BEER_TEMPLATE = """<html><body>
+<a class="label" href="#"><img src="/labels/{id}.png"></a>
+<div class="name"><h1>{name}</h1><p class="brewery"><a href="#">{brewery}</a></p><p class="style">{style}</p></div>
+<div class="details"><p class="abv">{abv}% ABV</p><div class="caps" data-rating="{rating}"></div>
+<p class="raters">{ratings} Ratings</p></div>
+</body></html>"""
+
+FIXTURE_STYLES = ["IPA - New England", "Stout - Imperial", "Lager - Pale", "Sour - Fruited", "Pale Ale - American"]
+FIXTURE_BREWERIES = ["Omnipollo", "Põhjala", "Sori Brewing", "Mikkeller", "Pyynikin"]
+
+
+class FakeUntappd:
+    """
+    Serves a venue menu, beer pages in the structure the crawler parses and beer label images
+    """
+
+    def __init__(self, beers=20, port=0, delay=0.0):
+        """
+        :param beers: Number of beers on each menu
+        :param port: TCP port, 0 for a free one
+        :param delay: Artificial latency per page in seconds, to mimic proxied fetches
+        """
+        self.beers = beers
+        self.delay = delay
+        self.pages = 0
+        self.labels = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.server.daemon_threads = True
+
+    def list_url(self, venue="kapina"):
+        return "http://127.0.0.1:{}/v/{}".format(self.server.server_address[1], venue)
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def beer(self, i):
+        return {"id": i,
+                "slug": "bench-beer-{}".format(i),
+                "name": "Bench Beer {}".format(i),
+                "brewery": FIXTURE_BREWERIES[i % len(FIXTURE_BREWERIES)],
+                "style": FIXTURE_STYLES[i % len(FIXTURE_STYLES)],
+                "abv": round(4.5 + (i * 7) % 80 / 10, 1),
+                "rating": round(3.0 + (i * 13) % 20 / 10, 2),
+                "ratings": 100 + i * 37}
+
+    def label(self, i):
+        import cv2
+        import numpy as np
+        img = np.full((400, 400, 3), (i * 37 % 256, i * 59 % 256, i * 83 % 256), dtype=np.uint8)
+        cv2.circle(img, (200, 200), 150, (255, 255, 255), 20)
+        return cv2.imencode(".png", img)[1].tobytes()
+
+    def page(self, path):
+        parts = path.strip("/").split("/")
+        if parts[0] == "v":
+            return MENU_TEMPLATE.format("".join(MENU_ITEM_TEMPLATE.format(**self.beer(i)) for i in range(self.beers)))
+        if parts[0] == "b" and len(parts) == 3:
+            return BEER_TEMPLATE.format(**self.beer(int(parts[2])))
+        return None
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if fake.delay:
+                    time.sleep(fake.delay)
+                path = urlparse(self.path).path
+                if path.startswith("/labels/"):
+                    fake.labels += 1
+                    body = fake.label(int(path.rsplit("/", 1)[1].split(".")[0]))
+                    content_type = "image/png"
+                else:
+                    page = fake.page(path)
+                    if page is None:
+                        self.send_error(404)
+                        return
+                    fake.pages += 1
+                    body = page.encode()
+                    content_type = "text/html; charset=utf-8"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class SyntheticCapture:
+    """
+    Stand-in for cv2.VideoCapture producing moving gradient frames
+    """
+
+    def __init__(self, width=1280, height=720):
+        import numpy as np
+        self.np = np
+        self.width = width
+        self.height = height
+        self.base = np.add.outer(np.arange(height) // 3, np.arange(width) // 5).astype(np.uint8)
+        self.n = 0
+
+    def set(self, prop, value):
+        return True
+
+    def read(self):
+        self.n += 1
+        channel = self.base + self.n
+        return True, self.np.dstack((channel, channel[::-1], channel[:, ::-1]))
+
+    def release(self):
+        pass
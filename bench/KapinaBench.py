@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Replay / load benchmark for KapinaBot.
+
+Runs the bot in a subprocess against a fake Telegram API, a fake Untappd site and a synthetic camera, replays a
+generated or recorded message stream at a configurable rate and reports throughput, reply latency, CPU and RSS.
+Each run is stored as JSON under the results directory and compared against the previous run.
+
+Usage:
+    python3 KapinaBench.py --rate 20 --duration 30
+    python3 KapinaBench.py --replay messages.jsonl --label recorded
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from FakeBackends import FakeTelegram, FakeUntappd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+
+# Generated traffic mix, command -> relative weight. "@bot ..." is sent as an inline query.
+DEFAULT_MIX = {"/kapina": 1,
+               "/kapina hd": 1,
+               "/kapina thumb": 1,
+               "/help": 1,
+               "/kalja": 3,
+               "/siideri": 1,
+               "/kaljat": 2,
+               "/kaljat total": 1,
+               "/kaljat chart": 1,
+               "/kaljat total chart week": 1,
+               "/top": 1,
+               "/streak": 1,
+               "/hours": 1,
+               "/hana": 2,
+               "/hana labels": 1,
+               "/hana ipa": 1,
+               "/hana abv>8 top 5": 1,
+               "@bot ipa": 2,
+               "@bot kapina": 1}
+
+DRINK_REPLIES = {"kalja": {"daily": {}, "total": {}},
+                 "siideri": {"daily": {}, "total": {}}}
+
+CONF_LOCAL = """
+from FakeBackends import SyntheticCapture
+
+telegram_api_url = {telegram_url!r}
+venues = {{"kapina": {{"lists": {{"hana": {untappd_url!r}}}}}}}
+untappd_use_proxy = False
+cameras = {{"kapina": {{"command": "/kapina", "camera_id": SyntheticCapture}}}}
+metrics_port = None
+admins = [{admin}]
+"""
+
+
+# Sender of the /profile command
+ADMIN_ID = 1000000
+
+
+def generate_stream(rate: float, duration: float, users: int, seed: int) -> List[Tuple[float, str, int]]:
+    """
+    Generates a message stream with exponential inter-arrival times
+    :return: List of (offset seconds, text, user id)
+    """
+    rnd = random.Random(seed)
+    commands = list(DEFAULT_MIX)
+    weights = list(DEFAULT_MIX.values())
+    stream = []
+    t = 0.0
+    while True:
+        t += rnd.expovariate(rate)
+        if t >= duration:
+            return stream
+        stream.append((t, rnd.choices(commands, weights)[0], rnd.randint(1, users)))
+
+
+def load_stream(path: str, rate: float) -> List[Tuple[float, str, int]]:
+    """
+    Loads a recorded stream, one JSON object per line with "text" and optional "user_id" and "at" (offset seconds).
+    Lines without offsets are spaced evenly at the given rate.
+    """
+    stream = []
+    with open(path, "r") as f:
+        for i, line in enumerate(l for l in f if l.strip()):
+            record = json.loads(line)
+            stream.append((float(record.get("at", i / rate)), record["text"], int(record.get("user_id", 1))))
+    return sorted(stream)
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+class ProcessSampler:
+    """
+    Reads CPU time and RSS of a process and its child processes (e.g. camera workers) from /proc
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.tick = os.sysconf("SC_CLK_TCK")
+        self.rss_peak = 0
+        # CPU time of exited child processes, by pid
+        self.cpu_seen = {}
+
+    def pids(self) -> List[int]:
+        pids = [self.pid]
+        for pid in pids:
+            try:
+                for task in os.listdir("/proc/{}/task".format(pid)):
+                    with open("/proc/{}/task/{}/children".format(pid, task)) as f:
+                        pids.extend(int(child) for child in f.read().split())
+            except OSError:
+                pass
+        return pids
+
+    def cpu_seconds(self) -> float:
+        for pid in self.pids():
+            try:
+                with open("/proc/{}/stat".format(pid)) as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                self.cpu_seen[pid] = (int(fields[11]) + int(fields[12])) / self.tick
+            except OSError:
+                pass
+        return sum(self.cpu_seen.values())
+
+    def sample_rss(self) -> float:
+        rss = 0.0
+        for pid in self.pids():
+            try:
+                with open("/proc/{}/status".format(pid)) as f:
+                    for line in f:
+                        if line.startswith("VmRSS:"):
+                            rss += int(line.split()[1]) / 1024
+            except OSError:
+                pass
+        self.rss_peak = max(self.rss_peak, rss)
+        return rss
+
+
+def wait_for(condition, timeout, interval=0.1) -> bool:
+    end = time.time() + timeout
+    while time.time() < end:
+        if condition():
+            return True
+        time.sleep(interval)
+    return False
+
+
+def start_bot(workdir: str, telegram: FakeTelegram, untappd: FakeUntappd, log_file) -> subprocess.Popen:
+    os.makedirs(os.path.join(workdir, "assets"), exist_ok=True)
+    with open(os.path.join(workdir, "assets", "token"), "w") as f:
+        f.write("bench")
+    with open(os.path.join(workdir, "assets", "drink_replies"), "w") as f:
+        json.dump(DRINK_REPLIES, f)
+    with open(os.path.join(workdir, "conf_local.py"), "w") as f:
+        f.write(CONF_LOCAL.format(telegram_url=telegram.url, untappd_url=untappd.list_url(), admin=ADMIN_ID))
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([BENCH_DIR, workdir, env.get("PYTHONPATH", "")])
+    return subprocess.Popen([sys.executable, os.path.join(SRC_DIR, "KapinaBot.py")],
+                            cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+
+def run(args) -> Dict:
+    if args.replay:
+        stream = load_stream(args.replay, args.rate)
+    else:
+        stream = generate_stream(args.rate, args.duration, args.users, args.seed)
+
+    telegram = FakeTelegram()
+    untappd = FakeUntappd(beers=args.beers, delay=args.untappd_delay)
+    telegram.start()
+    untappd.start()
+
+    workdir = tempfile.mkdtemp(prefix="kapinabench-")
+    log_path = os.path.join(workdir, "bot.log")
+    with open(log_path, "wb") as log_file:
+        started = time.perf_counter()
+        bot = start_bot(workdir, telegram, untappd, log_file)
+        sampler = ProcessSampler(bot.pid)
+        try:
+            # The bot is ready once it answers and the first crawl has gone through
+            probe = telegram.inject("/help")
+            if not wait_for(lambda: probe in telegram.replied_at or bot.poll() is not None, args.startup_timeout):
+                raise RuntimeError("Bot did not answer within {} s, see {}".format(args.startup_timeout, log_path))
+            if bot.poll() is not None:
+                raise RuntimeError("Bot exited during startup, see {}".format(log_path))
+            startup = telegram.replied_at[probe] - started
+            wait_for(lambda: untappd.pages > args.beers and untappd.labels >= args.beers, args.startup_timeout)
+
+            cpu_start = sampler.cpu_seconds()
+            load_start = time.perf_counter()
+            if args.profile:
+                profile = telegram.inject("/profile {:g}".format(args.profile), user_id=ADMIN_ID, username="admin")
+            injected = []
+            commands = {}
+            for offset, text, user_id in stream:
+                delay = load_start + offset - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if text.startswith("@bot"):
+                    # Inline query
+                    injected.append(telegram.inject_inline(text[len("@bot"):].strip(), user_id=user_id,
+                                                           username="user{}".format(user_id)))
+                else:
+                    injected.append(telegram.inject(text, user_id=user_id, username="user{}".format(user_id)))
+                commands[injected[-1]] = text
+                sampler.sample_rss()
+
+            # Drain outstanding replies
+            end = time.time() + args.drain
+            while time.time() < end and any(i not in telegram.replied_at for i in injected):
+                sampler.sample_rss()
+                time.sleep(0.1)
+
+            cpu = sampler.cpu_seconds() - cpu_start
+            rss = sampler.sample_rss()
+            if args.profile:
+                wait_for(lambda: profile in telegram.documents, args.drain)
+        finally:
+            bot.terminate()
+            try:
+                bot.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                bot.kill()
+            telegram.stop()
+            untappd.stop()
+
+    latencies = [(telegram.replied_at[i] - telegram.sent_at[i]) * 1000 for i in injected if i in telegram.replied_at]
+    answered = [telegram.replied_at[i] for i in injected if i in telegram.replied_at]
+    window = (max(answered) - load_start) if answered else float("nan")
+
+    per_command = {}
+    for i in injected:
+        if i in telegram.replied_at:
+            per_command.setdefault(commands[i], []).append((telegram.replied_at[i] - telegram.sent_at[i]) * 1000)
+
+    return {"label": args.label,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(),
+            "config": {"rate": args.rate, "duration": args.duration, "users": args.users, "beers": args.beers,
+                       "untappd_delay": args.untappd_delay, "replay": args.replay, "seed": args.seed},
+            "messages": len(injected),
+            "answered": len(latencies),
+            "throughput": len(latencies) / window if answered else 0.0,
+            "latency_p50_ms": percentile(latencies, 50),
+            "latency_p99_ms": percentile(latencies, 99),
+            "latency_max_ms": max(latencies) if latencies else float("nan"),
+            "startup_s": startup,
+            "cpu_s": cpu,
+            "cpu_percent": 100 * cpu / window if answered else 0.0,
+            "rss_mb": rss,
+            "rss_peak_mb": sampler.rss_peak,
+            "label_uploads": telegram.uploads,
+            "commands": {command: {"answered": len(values),
+                                   "latency_p50_ms": percentile(values, 50),
+                                   "latency_p99_ms": percentile(values, 99)}
+                         for command, values in sorted(per_command.items())},
+            "profile": telegram.documents.get(profile).decode("utf-8", "replace")
+            if args.profile and profile in telegram.documents else None,
+            "log": log_path}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+REPORT_KEYS = ["messages", "answered", "throughput", "latency_p50_ms", "latency_p99_ms", "latency_max_ms",
+               "startup_s", "cpu_s", "cpu_percent", "rss_peak_mb"]
+
+
+def report(result: Dict, previous: Dict = None):
+    print("{:<16}{:>14}{:>14}{:>10}".format("metric", "this run", "previous", "change"))
+    for key in REPORT_KEYS:
+        value = result[key]
+        line = "{:<16}{:>14.2f}".format(key, value)
+        if previous is not None and key in previous:
+            change = (value - previous[key]) / previous[key] * 100 if previous[key] else float("nan")
+            line += "{:>14.2f}{:>9.1f}%".format(previous[key], change)
+        print(line)
+
+    print()
+    print("{:<20}{:>10}{:>14}{:>14}".format("command", "answered", "p50 ms", "p99 ms"))
+    for command, values in result["commands"].items():
+        print("{:<20}{:>10}{:>14.2f}{:>14.2f}".format(command, values["answered"],
+                                                    values["latency_p50_ms"], values["latency_p99_ms"]))
+
+
+def latest_result(results_dir: str) -> Dict:
+    if not os.path.isdir(results_dir):
+        return None
+    files = sorted(f for f in os.listdir(results_dir) if f.endswith(".json"))
+    if not files:
+        return None
+    with open(os.path.join(results_dir, files[-1])) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=10, help="messages per second")
+    parser.add_argument("--duration", type=float, default=20, help="load duration in seconds")
+    parser.add_argument("--users", type=int, default=20, help="distinct senders in generated traffic")
+    parser.add_argument("--beers", type=int, default=20, help="beers on the fake menu")
+    parser.add_argument("--untappd-delay", type=float, default=0.0, help="fake Untappd page latency in seconds")
+    parser.add_argument("--replay", help="recorded message stream (JSON lines) instead of generated traffic")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for outstanding replies")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--label", default="run")
+    parser.add_argument("--results-dir", default=os.path.join(BENCH_DIR, "results"))
+    parser.add_argument("--profile", type=float, metavar="SECONDS",
+                        help="profile the bot with /profile for the first SECONDS of the load, "
+                             "the report is stored next to the result")
+    parser.add_argument("--compare", help="result file to compare against, defaults to the latest stored run")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    else:
+        previous = latest_result(args.results_dir)
+
+    result = run(args)
+
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = os.path.join(args.results_dir, "{}-{}.json".format(result["timestamp"].replace(":", ""), args.label))
+    profile = result.pop("profile")
+    if profile is not None:
+        result["profile"] = path[:-len(".json")] + "-profile.txt"
+        with open(result["profile"], "w") as f:
+            f.write(profile)
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+
+    report(result, previous)
+    print("Result stored in " + path)
+    if result.get("profile"):
+        print("Profile stored in " + result["profile"])
+
+
+if __name__ == "__main__":
+    main()
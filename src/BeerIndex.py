@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Search over a beer list.
+
+An index is built once per list refresh: an inverted index from name, style and brewery tokens to beer positions,
+with the tokens kept sorted for prefix lookups, and the beers pre-sorted by rating and by ABV. Queries are then
+answered with a few bisects and set intersections, without looking at the beers one by one.
+
+Query syntax, terms are combined with AND:
+    ipa                 beers with a name, style or brewery word starting with "ipa"
+    brewery:omnipollo   the same for one field (name, style or brewery)
+    abv>8               ABV filter, also >=, <, <= and =
+    top 5               the 5 best rated matches, best first
+"""
+
+import re
+from bisect import bisect_left, bisect_right
+from itertools import islice
+from typing import Dict, FrozenSet, List, Optional
+
+FIELDS = ("name", "style", "brewery")
+ABV_RE = re.compile(r"(\d+(?:[.,]\d+)?)\s*%")
+ABV_FILTER_RE = re.compile(r"^abv(>=|<=|>|<|=)(\d+(?:[.,]\d+)?)%?$")
+TOKEN_RE = re.compile(r"\w+")
+DEFAULT_TOP = 5
+
+
+def parse_abv(text: str) -> Optional[float]:
+    """
+    Parses the ABV out of Untappd's ABV text, e.g. "8.5% ABV"
+    :param text: ABV text
+    :return: ABV in percent, None if not found
+    """
+    match = ABV_RE.search(text or "")
+    return float(match.group(1).replace(",", ".")) if match else None
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall((text or "").lower())
+
+
+class Query:
+    """
+    Parsed beer query
+    """
+
+    def __init__(self):
+        # (field or None for any field, word prefix)
+        self.terms = []
+        # (operator, value)
+        self.abv = []
+        self.limit = None
+
+    def __bool__(self):
+        return bool(self.terms or self.abv or self.limit is not None)
+
+
+def parse_query(words: List[str]) -> Query:
+    """
+    Parses query words
+    :param words: Query words
+    :return: Query
+    """
+    query = Query()
+    words = [word.lower() for word in words if word]
+    i = 0
+    while i < len(words):
+        word = words[i]
+        abv_filter = ABV_FILTER_RE.match(word)
+        if word == "top":
+            query.limit = DEFAULT_TOP
+            if i + 1 < len(words) and words[i + 1].isdigit():
+                query.limit = int(words[i + 1])
+                i += 1
+        elif abv_filter:
+            query.abv.append((abv_filter.group(1), float(abv_filter.group(2).replace(",", "."))))
+        else:
+            field, _, value = word.partition(":")
+            if value and field in FIELDS:
+                query.terms.extend((field, token) for token in tokenize(value))
+            else:
+                query.terms.extend((None, token) for token in tokenize(word))
+        i += 1
+    return query
+
+
+class BeerIndex:
+    """
+    Immutable search index over one beer list
+    """
+
+    def __init__(self, beers: List):
+        """
+        :param beers: Beers in menu order
+        """
+        self.beers = beers
+        self.abv = [parse_abv(beer.abv) for beer in beers]
+
+        # field -> token -> positions, None for any field
+        postings: Dict[Optional[str], Dict[str, set]] = {field: {} for field in FIELDS + (None,)}
+        for i, beer in enumerate(beers):
+            for field in FIELDS:
+                for token in tokenize(getattr(beer, field)):
+                    postings[field].setdefault(token, set()).add(i)
+                    postings[None].setdefault(token, set()).add(i)
+        self.postings: Dict[Optional[str], Dict[str, FrozenSet[int]]] = {
+            field: {token: frozenset(positions) for token, positions in tokens.items()}
+            for field, tokens in postings.items()}
+        self.tokens = {field: sorted(tokens) for field, tokens in self.postings.items()}
+
+        self.by_rating = sorted(range(len(beers)), key=lambda i: -(beers[i].rating or 0))
+        self.by_abv = sorted((i for i in range(len(beers)) if self.abv[i] is not None), key=lambda i: self.abv[i])
+        self.abv_sorted = [self.abv[i] for i in self.by_abv]
+        self.all = frozenset(range(len(beers)))
+
+    def prefix(self, word: str, field: str = None) -> FrozenSet[int]:
+        """
+        :param word: Token prefix
+        :param field: Beer field, None for any field
+        :return: Positions of beers with a token starting with the prefix
+        """
+        tokens = self.tokens[field]
+        postings = self.postings[field]
+        exact = postings.get(word)
+        start = bisect_left(tokens, word)
+        end = bisect_left(tokens, word + "\uffff", start)
+        if exact is not None and end - start == 1:
+            return exact
+        return frozenset().union(*(postings[token] for token in tokens[start:end]))
+
+    def abv_range(self, op: str, value: float) -> FrozenSet[int]:
+        """
+        :param op: Comparison operator, one of >, >=, <, <=, =
+        :param value: ABV in percent
+        :return: Positions of beers whose ABV compares true
+        """
+        if op == ">":
+            positions = self.by_abv[bisect_right(self.abv_sorted, value):]
+        elif op == ">=":
+            positions = self.by_abv[bisect_left(self.abv_sorted, value):]
+        elif op == "<":
+            positions = self.by_abv[:bisect_left(self.abv_sorted, value)]
+        elif op == "<=":
+            positions = self.by_abv[:bisect_right(self.abv_sorted, value)]
+        else:
+            positions = self.by_abv[bisect_left(self.abv_sorted, value):bisect_right(self.abv_sorted, value)]
+        return frozenset(positions)
+
+    def match(self, query: Query) -> List[int]:
+        """
+        :param query: Parsed query
+        :return: Positions of the matching beers, in menu order or best rated first if the query has a limit
+        """
+        if not query:
+            return list(range(len(self.beers)))
+
+        matches = self.all
+        for field, word in query.terms:
+            matches = matches & self.prefix(word, field)
+            if not matches:
+                return []
+        for op, value in query.abv:
+            matches = matches & self.abv_range(op, value)
+            if not matches:
+                return []
+
+        if query.limit is None:
+            return sorted(matches)
+        if len(matches) == len(self.beers):
+            return self.by_rating[:query.limit]
+        return list(islice((i for i in self.by_rating if i in matches), query.limit))
+
+    def search(self, query: Query) -> List:
+        """
+        :param query: Parsed query
+        :return: Matching beers, in menu order or best rated first if the query has a limit
+        """
+        if not query:
+            return self.beers
+        return [self.beers[i] for i in self.match(query)]
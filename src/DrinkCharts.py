@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Drink statistics charts.
+
+Charts are drawn with OpenCV in a separate process, so rendering never holds the GIL of the bot's handler threads.
+Rendered PNGs are cached by scope (chat, or chat and drinker), range and the id of the last drink in the scope, and a
+scope's charts are dropped when a drink is added to it. Repeated requests are served from the cache.
+"""
+
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+import Metrics
+import LogUtils
+from WorkerPool import WorkerPool
+
+log = LogUtils.get_logger("DrinkCharts")
+
+WIDTH = 800
+HEIGHT = 420
+MARGIN_LEFT = 50
+MARGIN_RIGHT = 20
+MARGIN_TOP = 60
+MARGIN_BOTTOM = 50
+
+# BGR
+PALETTE = [(48, 130, 230), (60, 180, 75), (200, 130, 0), (180, 30, 145), (40, 40, 220), (0, 190, 190)]
+AXIS_COLOR = (60, 60, 60)
+GRID_COLOR = (225, 225, 225)
+
+
+def render_chart(title: str, labels: List[str], series: Dict[str, List[int]]) -> Optional[bytes]:
+    """
+    Draws a stacked bar chart
+    :param title: Chart title, ASCII
+    :param labels: Bar labels
+    :param series: Drink type -> count per bar
+    :return: PNG bytes, None if encoding failed
+    """
+    import cv2
+    import numpy as np
+
+    img = np.full((HEIGHT, WIDTH, 3), 255, dtype=np.uint8)
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    cv2.putText(img, title, (MARGIN_LEFT, 30), font, 0.7, AXIS_COLOR, 2, cv2.LINE_AA)
+
+    totals = [sum(counts) for counts in zip(*series.values())] or [0] * len(labels)
+    top = max(max(totals, default=0), 1)
+    step = max(1, -(-top // 5))
+    top = -(-top // step) * step
+
+    plot_w = WIDTH - MARGIN_LEFT - MARGIN_RIGHT
+    plot_h = HEIGHT - MARGIN_TOP - MARGIN_BOTTOM
+    bottom = HEIGHT - MARGIN_BOTTOM
+
+    def y(value):
+        return int(bottom - value * plot_h / top)
+
+    for tick in range(0, top + 1, step):
+        cv2.line(img, (MARGIN_LEFT, y(tick)), (WIDTH - MARGIN_RIGHT, y(tick)), GRID_COLOR, 1)
+        cv2.putText(img, str(tick), (8, y(tick) + 5), font, 0.45, AXIS_COLOR, 1, cv2.LINE_AA)
+
+    slot = plot_w / max(len(labels), 1)
+    bar_w = max(2, int(slot * 0.7))
+    for i, label in enumerate(labels):
+        x0 = int(MARGIN_LEFT + i * slot + (slot - bar_w) / 2)
+        stacked = 0
+        for j, counts in enumerate(series.values()):
+            if counts[i]:
+                cv2.rectangle(img, (x0, y(stacked + counts[i])), (x0 + bar_w, y(stacked)),
+                              PALETTE[j % len(PALETTE)], -1)
+                stacked += counts[i]
+        if totals[i]:
+            cv2.putText(img, str(totals[i]), (x0, y(totals[i]) - 4), font, 0.4, AXIS_COLOR, 1, cv2.LINE_AA)
+        cv2.putText(img, label, (x0 - 2, bottom + 18), font, 0.4, AXIS_COLOR, 1, cv2.LINE_AA)
+
+    cv2.line(img, (MARGIN_LEFT, bottom), (WIDTH - MARGIN_RIGHT, bottom), AXIS_COLOR, 1)
+
+    x = WIDTH - MARGIN_RIGHT
+    for j, drink in reversed(list(enumerate(series))):
+        (text_w, _), _ = cv2.getTextSize(drink, font, 0.5, 1)
+        x -= text_w + 24
+        cv2.rectangle(img, (x, 20), (x + 12, 32), PALETTE[j % len(PALETTE)], -1)
+        cv2.putText(img, drink, (x + 16, 32), font, 0.5, AXIS_COLOR, 1, cv2.LINE_AA)
+
+    ok, png = cv2.imencode(".png", img)
+    return png.tobytes() if ok else None
+
+
+class ChartCache:
+    """
+    Renders charts in a worker process and caches them.
+    Entries are futures, so concurrent requests for the same chart share one rendering.
+    """
+
+    def __init__(self, max_entries=64):
+        """
+        :param max_entries: Maximum number of cached charts
+        """
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # (scope, range, last drink id) -> Future of PNG bytes, least recently used first
+        self.charts: OrderedDict = OrderedDict()
+        self.pool = WorkerPool("charts", 1)
+
+    def get(self, key: Tuple, data: Callable[[], Tuple]) -> Optional[bytes]:
+        """
+        Returns a cached chart or renders it
+        :param key: (scope, range, last drink id)
+        :param data: Function returning the render_chart arguments, only called on a cache miss
+        :return: PNG bytes, None if rendering failed
+        """
+        render = False
+        with self.lock:
+            future = self.charts.get(key)
+            if future is not None:
+                self.charts.move_to_end(key)
+                Metrics.chart_cache.inc("hit")
+            else:
+                future = self.charts[key] = Future()
+                while len(self.charts) > self.max_entries:
+                    self.charts.popitem(last=False)
+                render = True
+                Metrics.chart_cache.inc("miss")
+
+        if render:
+            try:
+                with Metrics.chart_render.time():
+                    future.set_result(self.pool.run(render_chart, *data()))
+            except Exception as e:
+                log.warning("Chart rendering failed", extra={"fields": {"error": e}})
+                future.set_result(None)
+        return self.__result(key, future)
+
+    def __result(self, key, future) -> Optional[bytes]:
+        png = future.result()
+        if png is None:
+            with self.lock:
+                if self.charts.get(key) is future:
+                    del self.charts[key]
+        return png
+
+    def invalidate(self, scope: Tuple):
+        """
+        Drops the charts of a scope
+        :param scope: (chat id, drinker id or None)
+        :return: None
+        """
+        with self.lock:
+            for key in [key for key in self.charts if key[0] == scope]:
+                del self.charts[key]
@@ -5,47 +5,202 @@ import sqlite3
 import time
 import json
 import random
-from datetime import datetime
-from typing import Tuple
-from threading import Semaphore
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from threading import Lock, Semaphore
 
 from TelegramUtils import TelegramHttpsAPI, Message
+from DrinkCharts import ChartCache
+import Metrics
+import LogUtils
+
+log = LogUtils.get_logger("DrinkTrackerUtils")
+
+
+DRINK_REPLIES_FILE = "assets/drink_replies"
+
+
+def load_drink_replies(path: str = DRINK_REPLIES_FILE) -> Dict:
+    """
+    Loads the drink types and their special replies
+    :param path: Replies JSON file
+    :return: Dict["Drink type": {"daily": {...}, "total": {...}}]
+    """
+    with open(path, "r") as f:
+        replies = json.load(f)
+    log.debug("Loaded drink replies", extra={"fields": {"drinks": ",".join(replies)}})
+    return replies
+
+
+def drink_commands(replies: Dict) -> Dict[str, str]:
+    """
+    :param replies: Drink replies, see load_drink_replies
+    :return: Dict["Drink type": "Command"]
+    """
+    return {drink: "/" + drink for drink in replies}
+
+
+def time_buckets(timestamp: float) -> Dict[str, str]:
+    """
+    Rollup buckets of a point in time, in local time
+    :param timestamp: UNIX seconds
+    :return: Dict["day"/"week"/"month"/"all": bucket key]
+    """
+    t = datetime.fromtimestamp(timestamp)
+    year, week, _ = t.isocalendar()
+    return {"day": t.strftime("%Y-%m-%d"),
+            "week": "{}-W{:02d}".format(year, week),
+            "month": t.strftime("%Y-%m"),
+            "all": ""}
+
+
+def recent_buckets(period: str, count: int) -> List[Tuple[str, date]]:
+    """
+    The latest rollup buckets of a period up to today, in local time
+    :param period: "day" or "week"
+    :param count: Number of buckets
+    :return: List of (bucket key, first day of the bucket), oldest first
+    """
+    today = date.today()
+    if period == "day":
+        days = [today - timedelta(days=i) for i in reversed(range(count))]
+        return [(day.strftime("%Y-%m-%d"), day) for day in days]
+
+    monday = today - timedelta(days=today.weekday())
+    weeks = [monday - timedelta(weeks=i) for i in reversed(range(count))]
+    return [("{}-W{:02d}".format(*week.isocalendar()[:2]), week) for week in weeks]
 
 
 class DBAPI:
+    """
+    Drink records are stored as raw rows in drinkstats, partitioned by chat. Counts per day, week, month and
+    all time and per hour of day are maintained incrementally in rollup tables, so statistics never need to scan
+    the raw rows and each query only touches the rows of one chat.
+    """
     sql_create_stats_table = """CREATE TABLE IF NOT EXISTS drinkstats (
                                         id integer PRIMARY KEY,
                                         telegram_id integer NOT NULL,
                                         telegram_username text,
                                         telegram_name text,
                                         date integer NOT NULL,
-                                        drink_type text
+                                        drink_type text,
+                                        chat_id integer NOT NULL
                                     ); """
 
-    sql_insert_drink = """ INSERT INTO drinkstats (telegram_id, telegram_username, telegram_name, date, drink_type)
-              values (?,?,?,?,?) """
+    sql_add_chat_column = "ALTER TABLE drinkstats ADD COLUMN chat_id integer NOT NULL DEFAULT {:d}"
 
-    sql_get_drinks = "select count(*) from drinkstats where telegram_id like ? and drink_type like ?"
+    sql_create_stats_index = """CREATE INDEX IF NOT EXISTS drinkstats_chat_user_date
+                                ON drinkstats (chat_id, telegram_id, date)"""
 
-    sql_get_drinks_today = """ 
-                            select count(*) from drinkstats where 
-                            telegram_id like ? 
-                            and drink_type like ? 
-                            and date between ? and ? 
-                            """
+    sql_create_rollup_table = """CREATE TABLE IF NOT EXISTS drinkstats_rollup (
+                                        chat_id integer NOT NULL,
+                                        period text NOT NULL,
+                                        bucket text NOT NULL,
+                                        telegram_id integer NOT NULL,
+                                        drink_type text NOT NULL,
+                                        count integer NOT NULL,
+                                        PRIMARY KEY (chat_id, period, bucket, telegram_id, drink_type)
+                                    ); """
+
+    sql_create_rollup_index = """CREATE INDEX IF NOT EXISTS drinkstats_rollup_user
+                                 ON drinkstats_rollup (chat_id, telegram_id, period, bucket)"""
+
+    sql_create_hours_table = """CREATE TABLE IF NOT EXISTS drinkstats_hours (
+                                        chat_id integer NOT NULL,
+                                        telegram_id integer NOT NULL,
+                                        drink_type text NOT NULL,
+                                        hour integer NOT NULL,
+                                        count integer NOT NULL,
+                                        PRIMARY KEY (chat_id, telegram_id, drink_type, hour)
+                                    ); """
 
-    def __init__(self, db_file):
+    sql_create_drinkers_table = """CREATE TABLE IF NOT EXISTS drinkers (
+                                        telegram_id integer PRIMARY KEY,
+                                        telegram_username text,
+                                        telegram_name text
+                                    ); """
+
+    sql_insert_drink = """ INSERT INTO drinkstats (telegram_id, telegram_username, telegram_name, date, drink_type,
+                                                   chat_id)
+              values (?,?,?,?,?,?) """
+
+    sql_upsert_rollup = """ INSERT INTO drinkstats_rollup (chat_id, period, bucket, telegram_id, drink_type, count)
+              values (?,?,?,?,?,1)
+              ON CONFLICT (chat_id, period, bucket, telegram_id, drink_type) DO UPDATE SET count = count + 1 """
+
+    sql_upsert_hour = """ INSERT INTO drinkstats_hours (chat_id, telegram_id, drink_type, hour, count)
+              values (?,?,?,?,1)
+              ON CONFLICT (chat_id, telegram_id, drink_type, hour) DO UPDATE SET count = count + 1 """
+
+    sql_upsert_drinker = """ INSERT INTO drinkers (telegram_id, telegram_username, telegram_name)
+              values (?,?,?)
+              ON CONFLICT (telegram_id) DO UPDATE SET telegram_username = excluded.telegram_username,
+                                                      telegram_name = coalesce(excluded.telegram_name, telegram_name)
+              """
+
+    # Optional filters are appended to the queries below
+    sql_get_drinks = """
+                     select coalesce(sum(count), 0) from drinkstats_rollup where
+                     chat_id = ?
+                     and period = ?
+                     and bucket = ?
+                     """
+
+    sql_get_leaderboard = """
+                          select coalesce(d.telegram_username, d.telegram_name, r.telegram_id), sum(r.count) as total
+                          from drinkstats_rollup r left join drinkers d on d.telegram_id = r.telegram_id
+                          where r.chat_id = ?
+                          and r.period = ?
+                          and r.bucket = ?
+                          {}
+                          group by r.telegram_id
+                          order by total desc
+                          limit ?
+                          """
+
+    sql_get_active_days = """
+                          select distinct bucket from drinkstats_rollup where
+                          chat_id = ?
+                          and telegram_id = ?
+                          and period = 'day'
+                          order by bucket
+                          """
+
+    sql_get_series = """
+                     select bucket, drink_type, sum(count) from drinkstats_rollup where
+                     chat_id = ?
+                     and period = ?
+                     and bucket >= ?
+                     {}
+                     group by bucket, drink_type
+                     """
+
+    sql_get_last_drink = """
+                         select max(id) from drinkstats where
+                         chat_id = ?
+                         """
+
+    sql_get_hours = """
+                    select hour, sum(count) from drinkstats_hours where
+                    chat_id = ?
+                    {}
+                    group by hour
+                    """
+
+    def __init__(self, db_file, legacy_chat_id=None):
         """
         Initializes the database api to work on given file
         :param db_file: database file
+        :param legacy_chat_id: Chat the records of databases created before per-chat records are assigned to.
+                               A database with such records is not migrated while this is None.
         """
         self.db_sem = Semaphore(1)
+        self.legacy_chat_id = legacy_chat_id
         try:
             self.conn = sqlite3.connect(db_file, check_same_thread=False)
             self.__init_tables()
         except sqlite3.Error as e:
-            print("Database connection failed")
-            print(e)
+            log.error("Database connection failed", extra={"fields": {"error": e}})
 
     def __str__(self):
         return str(self.__execute("select * from drinkstats").fetchall())
@@ -57,123 +212,362 @@ class DBAPI:
         :param args: arguments to sqlite3.dbapi2.Cursor.execute()
         :return: Cursor if command succeeds, False if not
         """
+        return self.__execute_many([(cmd, args)])
+
+    def __execute_many(self, commands: List[Tuple[str, tuple]]):
+        """
+        Execute SQL commands in a single transaction
+        :param commands: List of (command, arguments) pairs
+        :return: Cursor of the last command if all commands succeed, False if not
+        """
         with self.db_sem:
             c = self.conn.cursor()
             try:
-                with self.conn:
-                    c.execute(cmd, args)
+                with Metrics.db_query.time(), self.conn:
+                    for cmd, args in commands:
+                        c.execute(cmd, args)
                 return c
             except sqlite3.Error as e:
-                print("Error running DB command")
-                print(e)
+                log.error("Error running DB command", extra={"fields": {"error": e}})
                 return False
 
-            except Exception as e:
-                print("Unknown error when running DB command")
-                print(e)
+            except Exception:
+                log.exception("Unknown error when running DB command")
                 return False
 
+    @staticmethod
+    def __filters(**conditions) -> Tuple[str, tuple]:
+        """
+        Builds SQL conditions for the given non-None column values
+        :param conditions: Column name -> value
+        :return: SQL "and ..." clauses and their arguments
+        """
+        columns = [column for column, value in conditions.items() if value is not None]
+        return "".join(" and {} = ?".format(column) for column in columns), \
+            tuple(conditions[column] for column in columns)
+
+    def __columns(self, table) -> List[str]:
+        return [row[1] for row in self.__execute("pragma table_info({})".format(table)).fetchall()]
+
     def __init_tables(self):
         """
-        Initializes tables
+        Initializes tables and migrates old databases.
+        Records without a chat are assigned to the legacy chat, and the rollups are (re)built from the raw records
+        if they are missing or predate per-chat records.
         :return: None
         """
         if not self.__execute(DBAPI.sql_create_stats_table):
-            print("Table init failed")
+            log.error("Table init failed")
+            return
+
+        if "chat_id" not in self.__columns("drinkstats"):
+            records = self.__execute("select count(*) from drinkstats").fetchone()[0]
+            if records and self.legacy_chat_id is None:
+                log.error("Drink records have no chat, set drinkstats_legacy_chat_id to migrate them",
+                          extra={"fields": {"records": records}})
+                self.conn.close()
+                raise RuntimeError("Legacy chat of the drink records not configured")
+            log.info("Adding chat to drink records", extra={"fields": {"legacy_chat_id": self.legacy_chat_id,
+                                                                       "records": records}})
+            self.__execute(DBAPI.sql_add_chat_column.format(int(self.legacy_chat_id or 0)))
+
+        for table in ("drinkstats_rollup", "drinkstats_hours"):
+            columns = self.__columns(table)
+            if columns and "chat_id" not in columns:
+                self.__execute("drop table {}".format(table))
+
+        for cmd in (DBAPI.sql_create_stats_index,
+                    DBAPI.sql_create_rollup_table,
+                    DBAPI.sql_create_rollup_index,
+                    DBAPI.sql_create_hours_table,
+                    DBAPI.sql_create_drinkers_table):
+            if not self.__execute(cmd):
+                log.error("Table init failed")
+                return
+
+        if self.__execute("select count(*) from drinkstats_rollup").fetchone()[0] == 0 and \
+                self.__execute("select count(*) from drinkstats").fetchone()[0] > 0:
+            self.rebuild_rollups()
+
+    def __rollup_commands(self, chat_id, telegram_id, telegram_username, telegram_name, date, drink_type):
+        commands = [(DBAPI.sql_upsert_rollup, (chat_id, period, bucket, telegram_id, drink_type))
+                    for period, bucket in time_buckets(date).items()]
+        commands.append((DBAPI.sql_upsert_hour,
+                         (chat_id, telegram_id, drink_type, datetime.fromtimestamp(date).hour)))
+        commands.append((DBAPI.sql_upsert_drinker, (telegram_id, telegram_username, telegram_name)))
+        return commands
 
     def add_drink(self,
+                  chat_id,
                   telegram_id,
                   telegram_username,
                   date,
                   drink_type,
                   telegram_name=None):
         """
-        Adds one drink record to the database
+        Adds one drink record to the database and updates the rollups
+        :param chat_id: telegram chat the drink was logged in
         :param telegram_id: telegram user ID (always present)
         :param telegram_username: telegram username (not always present but required)
         :param date: timestamp (UNIX seconds)
         :param drink_type: drink type
         :param telegram_name: real name, optional
+        :return: Id of the new record, None if failed
+        """
+        commands = self.__rollup_commands(chat_id, telegram_id, telegram_username, telegram_name, date, drink_type)
+        # Last, so the cursor holds its row id
+        commands.append((DBAPI.sql_insert_drink,
+                         (telegram_id, telegram_username, telegram_name, date, drink_type, chat_id)))
+        cursor = self.__execute_many(commands)
+        if not cursor:
+            log.error("Drink insertion failed")
+            return None
+        return cursor.lastrowid
+
+    def reassign_chat(self, from_chat_id, to_chat_id):
+        """
+        Moves the drink records of a chat to another chat and rebuilds the rollups, e.g. to fix records migrated to
+        the wrong legacy chat
+        :param from_chat_id: Current chat of the records
+        :param to_chat_id: New chat of the records
+        :return: None
+        """
+        cursor = self.__execute("update drinkstats set chat_id = ? where chat_id = ?", to_chat_id, from_chat_id)
+        if not cursor:
+            log.error("Reassigning drink records failed")
+            return
+        log.info("Drink records reassigned", extra={"fields": {"from_chat_id": from_chat_id,
+                                                               "to_chat_id": to_chat_id,
+                                                               "records": cursor.rowcount}})
+        self.rebuild_rollups()
+
+    def rebuild_rollups(self):
+        """
+        Rebuilds all rollup tables from the raw drink records
         :return: None
         """
+        log.info("Rebuilding drink rollups")
+        rows = self.__execute("select chat_id, telegram_id, telegram_username, telegram_name, date, drink_type "
+                              "from drinkstats order by id").fetchall()
+        commands = [("delete from drinkstats_rollup", ()),
+                    ("delete from drinkstats_hours", ()),
+                    ("delete from drinkers", ())]
+        for row in rows:
+            commands += self.__rollup_commands(*row)
+        if not self.__execute_many(commands):
+            log.error("Rollup rebuild failed")
+        else:
+            log.info("Drink rollups rebuilt", extra={"fields": {"records": len(rows)}})
+
+    def get_total_drinks(self, chat_id, telegram_id=None, drink_type=None, bucket: Tuple[str, str] = ("all", "")):
+        """
+        Get total amount of drinks consumed in a chat with constraining SQL parameters
+        :param chat_id: Chat for the query
+        :param telegram_id: Drinkers telegram id for the query, None for all drinkers
+        :param drink_type: Drink type for the query, None for all drinks
+        :param bucket: (period, bucket key) to count, e.g. ("day", "2020-01-31"). Defaults to all time.
+        :return: Number of drinks or None in case of error
+        """
+        filters, args = DBAPI.__filters(telegram_id=telegram_id, drink_type=drink_type)
+        try:
+            return self.__execute(DBAPI.sql_get_drinks + filters, chat_id, bucket[0], bucket[1], *args).fetchone()[0]
+        except (sqlite3.Error, AttributeError) as e:
+            log.error("Error getting total drinks!", extra={"fields": {"error": e}})
 
-        if not self.__execute(DBAPI.sql_insert_drink,
-                              telegram_id, telegram_username, telegram_name, date, drink_type):
-            print("Drink insertion failed")
+    def get_leaderboard(self, chat_id, period, bucket, drink_type, limit) -> List[Tuple[str, int]]:
+        """
+        Get the drinkers of a chat with most drinks within a rollup bucket
+        :param chat_id: Chat for the query
+        :param period: "day", "week", "month" or "all"
+        :param bucket: Bucket key
+        :param drink_type: Drink type for the query, None for all drinks
+        :param limit: Maximum number of drinkers
+        :return: List of (name, count), most drinks first
+        """
+        filters, args = DBAPI.__filters(**{"r.drink_type": drink_type})
+        result = self.__execute(DBAPI.sql_get_leaderboard.format(filters), chat_id, period, bucket, *args, limit)
+        return result.fetchall() if result else []
 
-    def get_total_drinks(self, telegram_id, drink_type, time_range: Tuple[float, float] = None):
+    def get_active_days(self, chat_id, telegram_id) -> List[str]:
         """
-        Get total amount of drinks consumed with constraining SQL parameters
+        :param chat_id: Chat for the query
         :param telegram_id: Drinkers telegram id for the query
-        :param drink_type: Drink type for the query
-        :param time_range: Time range for the query. Defaults to all timeframes (None)
-        :return: Number of drinks or None in case of error
+        :return: Day buckets with drinks in ascending order
         """
-        try:
-            if time_range is None:
-                return self.__execute(DBAPI.sql_get_drinks,
-                                      telegram_id, drink_type).fetchone()[0]
-            else:
-                return self.__execute(DBAPI.sql_get_drinks_today,
-                                      telegram_id, drink_type, time_range[0], time_range[1]).fetchone()[0]
-        except sqlite3.Error as e:
-            print("Error getting total drinks!")
-            print(e)
+        result = self.__execute(DBAPI.sql_get_active_days, chat_id, telegram_id)
+        return [row[0] for row in result.fetchall()] if result else []
+
+    def get_series(self, chat_id, period, first_bucket, telegram_id=None) -> List[Tuple[str, str, int]]:
+        """
+        :param chat_id: Chat for the query
+        :param period: "day", "week" or "month"
+        :param first_bucket: Bucket key to start from
+        :param telegram_id: Drinkers telegram id for the query, None for all drinkers
+        :return: List of (bucket, drink type, count)
+        """
+        filters, args = DBAPI.__filters(telegram_id=telegram_id)
+        result = self.__execute(DBAPI.sql_get_series.format(filters), chat_id, period, first_bucket, *args)
+        return result.fetchall() if result else []
+
+    def get_last_drink_id(self, chat_id, telegram_id=None) -> int:
+        """
+        :param chat_id: Chat for the query
+        :param telegram_id: Drinkers telegram id for the query, None for all drinkers
+        :return: Id of the latest drink record, 0 if none
+        """
+        filters, args = DBAPI.__filters(telegram_id=telegram_id)
+        result = self.__execute(DBAPI.sql_get_last_drink + filters, chat_id, *args)
+        return (result.fetchone()[0] or 0) if result else 0
+
+    def get_hours(self, chat_id, telegram_id=None, drink_type=None) -> List[int]:
+        """
+        :param chat_id: Chat for the query
+        :param telegram_id: Drinkers telegram id for the query, None for all drinkers
+        :param drink_type: Drink type for the query, None for all drinks
+        :return: Drink counts per hour of day
+        """
+        hours = [0] * 24
+        filters, args = DBAPI.__filters(telegram_id=telegram_id, drink_type=drink_type)
+        result = self.__execute(DBAPI.sql_get_hours.format(filters), chat_id, *args)
+        for hour, count in result.fetchall() if result else []:
+            hours[hour] = count
+        return hours
 
 
 class DrinkTracker:
-    def __init__(self):
-        self.db = DBAPI("./drinkstats.db")
-        with open("assets/drink_replies", "r") as f:
-            self.replies = json.load(f)
-            print(self.replies)
+    # Bars per chart range
+    CHART_RANGES = {"day": 14, "week": 12}
 
-    def get_drink_cmds(self):
-        cmds = {}
-        for drink in self.replies.keys():
-            cmds[drink] = "/" + drink
+    def __init__(self, legacy_chat_id=None):
+        """
+        :param legacy_chat_id: Chat the drinks logged before per-chat records belong to
+        """
+        self.db = DBAPI("./drinkstats.db", legacy_chat_id)
+        self.charts = ChartCache()
+        # (chat id, drinker id or None) -> id of the latest drink, loaded on first use
+        self.last_drink: Dict[Tuple, int] = {}
+        self.last_drink_lock = Lock()
+        self.replies = load_drink_replies()
 
-        return cmds
+    def get_drink_cmds(self):
+        return drink_commands(self.replies)
 
     def add_drink(self,
+                  chat_id,
                   telegram_id,
                   telegram_username,
                   drink_type,
                   telegram_name=None):
         """
         Adds a drink record for given user
+        :param chat_id: Chat the drink was logged in
         :param telegram_id: Drinkers telegram id
         :param telegram_username: Username
         :param drink_type: Drink type
         :param telegram_name: Drinkers telegram name if available
         :return: None
         """
-        print("Adding drink record for user: " + telegram_username)
-        self.db.add_drink(telegram_id, telegram_username, time.time(), drink_type, telegram_name)
-
-    def get_total_drinks(self, telegram_id="%", drink_type="%"):
+        log.info("Adding drink record", extra={"fields": {"chat": chat_id, "user": telegram_username,
+                                                          "drink": drink_type}})
+        drink_id = self.db.add_drink(chat_id, telegram_id, telegram_username, time.time(), drink_type, telegram_name)
+        if drink_id is not None:
+            with self.last_drink_lock:
+                for scope in ((chat_id, telegram_id), (chat_id, None)):
+                    self.last_drink[scope] = drink_id
+                    self.charts.invalidate(scope)
+
+    def get_total_drinks(self, chat_id, telegram_id=None, drink_type=None):
         """
-        Get total amount of drinks consumed
+        Get total amount of drinks consumed in a chat
+        :param chat_id: Chat id
         :param telegram_id: Drinker id. Defaults to all drinkers.
         :param drink_type: Drink type. Defaults to all drinks.
         :return: Amount of drinks consumed according to the given parameters
         """
-        return self.db.get_total_drinks(telegram_id, drink_type)
+        return self.db.get_total_drinks(chat_id, telegram_id, drink_type)
 
-    def get_total_drinks_today(self, telegram_id="%", drink_type="%"):
+    def get_total_drinks_today(self, chat_id, telegram_id=None, drink_type=None):
         """
-        Get total amount of drinks consumed during the ongoing day
+        Get total amount of drinks consumed in a chat during the ongoing day
+        :param chat_id: Chat id
         :param telegram_id: Drinker id. Defaults to all drinkers.
         :param drink_type: Drink type. Defaults to all drinks.
         :return: Amount of drinks consumed during the day according to given parameters.
         """
-        today = datetime.today()
-        daystart = datetime(year=today.year, month=today.month,
-                            day=today.day, hour=0, second=0).timestamp()
-        dayend = datetime(year=today.year, month=today.month,
-                          day=today.day, hour=23, minute=59, second=59).timestamp()
+        return self.db.get_total_drinks(chat_id, telegram_id, drink_type,
+                                        bucket=("day", time_buckets(time.time())["day"]))
 
-        return self.db.get_total_drinks(telegram_id, drink_type, time_range=(daystart, dayend))
+    def get_leaderboard(self, chat_id, period="week", drink_type=None, limit=5) -> List[Tuple[str, int]]:
+        """
+        Get the top drinkers of a chat during the ongoing week or month
+        :param chat_id: Chat id
+        :param period: "day", "week", "month" or "all"
+        :param drink_type: Drink type. Defaults to all drinks.
+        :param limit: Number of drinkers
+        :return: List of (name, count), most drinks first
+        """
+        return self.db.get_leaderboard(chat_id, period, time_buckets(time.time())[period], drink_type, limit)
+
+    def get_streak(self, chat_id, telegram_id) -> Tuple[int, int]:
+        """
+        Get the drinking streaks of a drinker in consecutive days
+        :param chat_id: Chat id
+        :param telegram_id: Drinker id
+        :return: (current streak, longest streak). Current streak counts up to today or yesterday.
+        """
+        days = [date.fromisoformat(day) for day in self.db.get_active_days(chat_id, telegram_id)]
+        longest = current = 0
+        previous = None
+        for day in days:
+            current = current + 1 if previous is not None and (day - previous).days == 1 else 1
+            longest = max(longest, current)
+            previous = day
+
+        if previous is None or (date.today() - previous).days > 1:
+            current = 0
+        return current, longest
+
+    def get_hour_histogram(self, chat_id, telegram_id=None, drink_type=None) -> List[int]:
+        """
+        Get drink counts of a chat per hour of day
+        :param chat_id: Chat id
+        :param telegram_id: Drinker id. Defaults to all drinkers.
+        :param drink_type: Drink type. Defaults to all drinks.
+        :return: List of 24 counts
+        """
+        return self.db.get_hours(chat_id, telegram_id, drink_type)
+
+    def get_chart(self, chat_id, telegram_id=None, period="day", title="") -> Optional[bytes]:
+        """
+        Get a chart of drinks per day or week by drink type, rendered or from the cache
+        :param chat_id: Chat id
+        :param telegram_id: Drinker id. Defaults to all drinkers.
+        :param period: "day" or "week"
+        :param title: Chart title
+        :return: PNG bytes, None if rendering failed
+        """
+        scope = (chat_id, telegram_id)
+        with self.last_drink_lock:
+            last_drink = self.last_drink.get(scope)
+        if last_drink is None:
+            last_drink = self.db.get_last_drink_id(chat_id, telegram_id)
+            with self.last_drink_lock:
+                last_drink = self.last_drink.setdefault(scope, last_drink)
+
+        buckets = recent_buckets(period, DrinkTracker.CHART_RANGES[period])
+
+        def data():
+            index = {bucket: i for i, (bucket, _) in enumerate(buckets)}
+            series = {drink: [0] * len(buckets) for drink in self.replies}
+            for bucket, drink, count in self.db.get_series(chat_id, period, buckets[0][0], telegram_id):
+                if bucket in index:
+                    series.setdefault(drink, [0] * len(buckets))[index[bucket]] = count
+            labels = [day.strftime("%d.%m") if period == "day" else "W" + bucket[-2:] for bucket, day in buckets]
+            return (title.encode("ascii", "replace").decode(),
+                    labels,
+                    {drink: counts for drink, counts in series.items() if any(counts)})
+
+        return self.charts.get((scope, (period, buckets[-1][0]), last_drink), data)
 
     def send_special_reply(self, api: TelegramHttpsAPI, message: Message, drink_type):
         """
@@ -184,11 +578,12 @@ class DrinkTracker:
         :return: True if a special message was found
         """
         reply_found = False
-        total_amount = str(self.get_total_drinks(telegram_id=message.user_id, drink_type=drink_type))
-        daily_amount = str(self.get_total_drinks_today(telegram_id=message.user_id, drink_type=drink_type))
+        total_amount = str(self.get_total_drinks(message.chat_id, telegram_id=message.user_id,
+                                                 drink_type=drink_type))
+        daily_amount = str(self.get_total_drinks_today(message.chat_id, telegram_id=message.user_id,
+                                                       drink_type=drink_type))
 
-        print(total_amount)
-        print(daily_amount)
+        log.debug("Drink amounts", extra={"fields": {"total": total_amount, "daily": daily_amount}})
 
         drink_daily_replies = self.replies[drink_type]["daily"]
         drink_total_replies = self.replies[drink_type]["total"]
@@ -213,6 +608,21 @@ class DrinkTracker:
 
 
 if __name__ == "__main__":
-    tracker = DrinkTracker()
-    tracker.add_drink(123, "123", "testi")
-
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Drink statistics database tools")
+    parser.add_argument("--db", default="./drinkstats.db", help="database file")
+    parser.add_argument("--legacy-chat-id", type=int,
+                        help="chat to assign records without a chat to when migrating an old database")
+    parser.add_argument("--reassign-chat", type=int, nargs=2, metavar=("FROM", "TO"),
+                        help="move the records of chat FROM to chat TO, e.g. records migrated to chat 0")
+    parser.add_argument("--rebuild-rollups", action="store_true", help="rebuild rollup tables from raw records")
+    args = parser.parse_args()
+
+    LogUtils.setup_logging()
+    db = DBAPI(args.db, args.legacy_chat_id)
+    if args.reassign_chat:
+        db.reassign_chat(*args.reassign_chat)
+    elif args.rebuild_rollups:
+        db.rebuild_rollups()
+    LogUtils.stop_logging()
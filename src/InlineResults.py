@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Answers to Telegram inline queries.
+
+Inline traffic comes in bursts, one query per keystroke, so everything is prepared ahead: the serialized result of
+every beer is built when its list is refreshed and the camera result when a snapshot has been uploaded. Answering a
+query is a prefix lookup in the beer indexes and joining the prepared results, repeated queries come straight from
+a cache that is emptied whenever the results change.
+"""
+
+import json
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from BeerIndex import BeerIndex, parse_query
+
+
+class InlineResults:
+    """
+    Precomputed inline query results of the beer lists and cameras
+    """
+
+    # Maximum number of results Telegram accepts in one answer
+    MAX_RESULTS = 50
+    # Answered queries kept, the cache is emptied when full
+    MAX_ANSWERS = 1024
+
+    def __init__(self, cache_time=300, snapshot_cache_time=15):
+        """
+        :param cache_time: Seconds Telegram may cache answers with beers only
+        :param snapshot_cache_time: Seconds Telegram may cache answers including a camera snapshot
+        """
+        self.cache_time = cache_time
+        self.snapshot_cache_time = snapshot_cache_time
+        self.lock = threading.Lock()
+        # List name -> (index, serialized result per beer position)
+        self.lists: Dict[str, Tuple[BeerIndex, List[str]]] = {}
+        # Camera name -> serialized photo result
+        self.snapshots: Dict[str, str] = {}
+        # Normalized query -> (results JSON, cache time)
+        self.answers: Dict[str, Tuple[str, int]] = {}
+
+    def set_list(self, list: str, index: BeerIndex):
+        """
+        Prepares the results of a refreshed beer list
+        :param list: List name
+        :param index: Index of the list
+        :return: None
+        """
+        results = []
+        for i, beer in enumerate(index.beers):
+            result = {"type": "article",
+                      "id": "{}-{}".format(list, i),
+                      "title": beer.name,
+                      "description": "{} - {}, {}, {:.2f}/5".format(beer.style, beer.brewery, beer.abv, beer.rating),
+                      "input_message_content": {"message_text": str(beer),
+                                                "parse_mode": "Markdown",
+                                                "disable_web_page_preview": True}}
+            if beer.img and beer.img.startswith("https://"):
+                result["thumbnail_url"] = beer.img
+            results.append(json.dumps(result))
+
+        with self.lock:
+            self.lists = {**self.lists, list: (index, results)}
+            self.answers = {}
+
+    def set_snapshot(self, camera: str, file_id: str):
+        """
+        Prepares the result of a camera from its latest uploaded snapshot
+        :param camera: Camera name
+        :param file_id: Telegram file id of the snapshot
+        :return: None
+        """
+        result = json.dumps({"type": "photo",
+                             "id": "cam-" + camera,
+                             "photo_file_id": file_id,
+                             "title": camera,
+                             "caption": "{} {}".format(camera, time.strftime("%H:%M"))})
+        with self.lock:
+            self.snapshots = {**self.snapshots, camera: result}
+            self.answers = {}
+
+    def answer(self, query: str) -> Tuple[str, int]:
+        """
+        Answers an inline query.
+        An empty query gives the camera snapshots and the beers of all lists. A query starting with a camera name
+        prefix gives that camera, one naming a list searches that list only. Other words are beer search terms,
+        see BeerIndex.
+        :param query: Query text
+        :return: Results as a JSON array, cache time in seconds
+        """
+        key = " ".join(query.lower().split())
+        answers = self.answers
+        cached = answers.get(key)
+        if cached is not None:
+            return cached
+
+        lists = self.lists
+        snapshots = self.snapshots
+        words = key.split()
+
+        results = []
+        camera_only = False
+        if not words:
+            results.extend(snapshots.values())
+        elif any(camera.startswith(words[0]) for camera in snapshots):
+            results.extend(result for camera, result in snapshots.items() if camera.startswith(words[0]))
+            words = words[1:]
+            camera_only = not words
+        photos = len(results)
+
+        selected = [word for word in words if word in lists]
+        words = [word for word in words if word not in lists]
+        if not camera_only:
+            beer_query = parse_query(words)
+            for list in selected or lists:
+                index, list_results = lists[list]
+                results.extend(list_results[i] for i in index.match(beer_query))
+                if len(results) >= InlineResults.MAX_RESULTS:
+                    break
+
+        answer = ("[" + ",".join(results[:InlineResults.MAX_RESULTS]) + "]",
+                  self.snapshot_cache_time if photos else self.cache_time)
+        with self.lock:
+            if answers is self.answers:
+                if len(self.answers) >= InlineResults.MAX_ANSWERS:
+                    self.answers = {}
+                self.answers[key] = answer
+        return answer
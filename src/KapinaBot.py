@@ -3,46 +3,140 @@
 
 import threading
 from concurrent.futures import ThreadPoolExecutor
-from typing import Dict
+import time
+from typing import Dict, List
 import sys
 import re
+import signal
 
 from conf import *
-from TelegramUtils import TelegramHttpsAPI, Message
-from KapinaCam import KapinaCam
-from UntappdUtils import Untappd
-from DrinkTrackerUtils import DrinkTracker
-
-"""
-Initialization
-"""
-try:
-    with open("assets/token", "r") as file:
-        TOKEN = file.read().replace("\n", "")
-except OSError:
-    print("Token file not found")
-    sys.exit(1)
-
-snapshot_sem = threading.Semaphore(1)
-api = TelegramHttpsAPI(TOKEN)
-cam = KapinaCam(snapshot_sem, snapshot_output_file)
-stats = DrinkTracker()
-drink_triggers = stats.get_drink_cmds()
-untappd = Untappd(5)
-tpe = ThreadPoolExecutor(max_workers=pool_size)
-
-
-def handle_image_request(message: Message):
+from TelegramUtils import TelegramHttpsAPI, Message, InlineQuery
+from KapinaCam import KapinaCam, DEFAULT_VARIANTS
+from UntappdUtils import Untappd, Beer
+import UntappdUtils
+from DrinkTrackerUtils import DrinkTracker, drink_commands, load_drink_replies
+from InlineResults import InlineResults
+import Metrics
+import LogUtils
+import Profiler
+from Services import ServiceContainer
+
+process_start = time.perf_counter()
+log = LogUtils.get_logger("KapinaBot")
+
+camera_triggers = {cameras[name]["command"]: name for name in cameras}
+
+# Set up by init(). Worker processes started with spawn import this module as __mp_main__, so nothing is done at
+# import time.
+api: TelegramHttpsAPI = None
+tpe: ThreadPoolExecutor = None
+inline_tpe: ThreadPoolExecutor = None
+profile_tpe: ThreadPoolExecutor = None
+inline: InlineResults = None
+services: ServiceContainer = None
+
+
+def init():
+    """
+    Sets up logging, the bot API, the thread pools and the subsystem registry
+    :return: None
+    """
+    global api, tpe, inline_tpe, profile_tpe, inline, services
+    LogUtils.setup_logging(log_levels, log_sampling)
+
+    try:
+        with open("assets/token", "r") as file:
+            token = file.read().replace("\n", "")
+    except OSError:
+        log.critical("Token file not found")
+        LogUtils.stop_logging()
+        sys.exit(1)
+
+    api = TelegramHttpsAPI(token, telegram_api_url)
+    tpe = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="handler")
+    # Inline answers are quick and latency sensitive, keep them from queueing behind slow commands
+    inline_tpe = ThreadPoolExecutor(max_workers=2, thread_name_prefix="inline")
+    # Profiles run for seconds, keep them from occupying a handler thread. The thread is started on the first profile.
+    profile_tpe = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profile")
+    inline = InlineResults(inline_cache_time, inline_snapshot_cache_time)
+
+    # Heavy subsystems are created on first use or by the warm-up in main()
+    services = ServiceContainer()
+    for camera in cameras:
+        services.register("cam_" + camera, lambda camera=camera: init_camera(camera))
+    services.register("stats", lambda: DrinkTracker(drinkstats_legacy_chat_id))
+    services.register("untappd", init_untappd)
+    # Only needs the replies file, so the poll loop never waits for the database
+    services.register("drink_triggers", lambda: drink_commands(load_drink_replies()))
+
+
+def init_untappd() -> Untappd:
+    untappd = Untappd(untappd_poll_interval, use_proxy=untappd_use_proxy, label_cache=label_cache,
+                      parse_workers=untappd_parse_workers)
+    untappd.set_venues(venues)
+    untappd.add_listener(inline.set_list)
+    untappd.start()
+    return untappd
+
+
+def init_camera(name: str) -> KapinaCam:
+    options = {k: v for k, v in cameras[name].items() if k != "command"}
+    return KapinaCam(log_levels=log_levels, log_sampling=log_sampling, **options)
+
+
+def submit(command: str, handler, *args, pool: ThreadPoolExecutor = None):
+    """
+    Submits a command handler to the thread pool and records its run time. Handler errors are logged, nothing reads
+    the returned future.
+    :param command: Command name for metrics and logs
+    :param handler: Handler function
+    :param args: Handler arguments
+    :param pool: Thread pool to run the handler in, defaults to the handler pool
+    :return: Future
+    """
+    def timed():
+        with Metrics.handler_latency.time(command):
+            try:
+                handler(*args)
+            except Exception:
+                log.exception("Command handler failed", extra={"fields": {"command": command}})
+
+    return (pool or tpe).submit(timed)
+
+
+def handle_image_request(message: Message, camera: str, cmd_arr):
     """
     Replies to the given message with a snapshot
     :param message: Message to reply to
+    :param camera: Camera name
+    :param cmd_arr: Command split to words, may name a snapshot variant
     :return: None
     """
-    cam.snapshot()
-    with snapshot_sem:
+    cam = services.get("cam_" + camera)
+    variant = next((word for word in cmd_arr if word in cam.variants), cam.default_variant)
+    snapshot = cam.snapshot(variant)
+    if snapshot is None:
         api.send_message(Message(chat_id=message.chat_id,
                                  reply_to=message.message_id,
-                                 photo=snapshot_output_file))
+                                 text="Camera not available right now"))
+        return
+
+    sent = api.send_message(Message(chat_id=message.chat_id,
+                                    reply_to=message.message_id,
+                                    photo=snapshot))
+    if sent and sent.get("photo") and variant == cam.default_variant:
+        # Inline queries reuse the uploaded snapshot
+        inline.set_snapshot(camera, sent["photo"][-1]["file_id"])
+
+
+def handle_inline_query(query: InlineQuery):
+    """
+    Answers an inline query from the precomputed results
+    :param query: Inline query
+    :return: None
+    """
+    results, cache_time = inline.answer(query.query)
+    api.answer_inline_query(query.query_id, results, cache_time)
 
 
 def handle_help_request(message: Message):
@@ -51,18 +145,32 @@ def handle_help_request(message: Message):
     :param message: Message to reply to
     :return: None
     """
-    help_text = "*Get a snapshot of kapina:*\n" \
-                "{}\n" \
+    help_text = "*Get a camera snapshot:*\n" \
+                "{} (+ {} for other sizes)\n" \
                 "*Log your drinks by sending:*\n" \
                 "{}\n" \
                 "*List your drinking records with:* \n" \
+                "{} (+ \"total\" for group records, \"chart\" and \"week\" for a chart)\n" \
+                "*Top drinkers:* \n" \
+                "{} (+ \"month\" and/or a drink type)\n" \
+                "*Your drinking streak:* \n" \
+                "{}\n" \
+                "*Drinks by hour of day:* \n" \
                 "{} (+ \"total\" for group records)\n" \
-                "*Currently available kapina beer infos:* \n" \
-                "{} \n" \
-        .format(triggers["image"],
-                "\n".join(drink_triggers.values()),
+                "*Currently available beer infos:* \n" \
+                "{} (+ \"{}\" for label pictures)\n" \
+                "_Search with e.g. ipa, brewery:omnipollo, abv>8, top 5_\n" \
+        .format("\n".join(camera_triggers),
+                " or ".join(sorted({"\"{}\"".format(variant) for camera in cameras.values()
+                                    for variant in camera.get("variants", DEFAULT_VARIANTS)
+                                    if variant != camera.get("default_variant", "standard")})),
+                "\n".join(services.drink_triggers.values()),
                 triggers["drink_records"],
-                "\n".join(beer_tap_triggers))
+                triggers["leaderboard"],
+                triggers["streak"],
+                triggers["hours"],
+                "\n".join(beer_tap_triggers),
+                beer_labels_keyword)
 
     api.send_message(Message(chat_id=message.chat_id,
                              reply_to=message.message_id,
@@ -70,14 +178,21 @@ def handle_help_request(message: Message):
                              text=help_text))
 
 
-def handle_beer_tap_request(message: Message, list_name: str):
+def handle_beer_tap_request(message: Message, list_name: str, query: List[str] = None, labels=False):
     """
     Replies to the given message with beer tap listing
     :param message: Mssage to reply to
     :param list_name: 
+    :param query: Search words, e.g. ["ipa", "abv>8", "top", "5"]
+    :param labels: Reply with an album of beer labels, beers without a cached label are listed as text
     :return: None
     """
-    beers = untappd.get_beers_on_list(list_name)
+    untappd = services.untappd
+    beers = untappd.search(list_name, query) if query else untappd.get_beers_on_list(list_name)
+    if labels and beers:
+        beers = send_beer_labels(message, beers)
+        if not beers:
+            return
     msg = ""
 
     for beer in beers:
@@ -85,7 +200,7 @@ def handle_beer_tap_request(message: Message, list_name: str):
         msg += "   \n"
 
     if msg == "":
-        msg = "Beer data not yet updated"
+        msg = "No matching beers" if query and list_name in untappd.indexes else "Beer data not yet updated"
 
     api.send_message(Message(chat_id=message.chat_id,
                              reply_to=message.message_id,
@@ -94,59 +209,140 @@ def handle_beer_tap_request(message: Message, list_name: str):
                              text=msg))
 
 
+def send_beer_labels(message: Message, beers: List[Beer]) -> List[Beer]:
+    """
+    Replies to the given message with label thumbnails of the beers, captioned with the beer info.
+    Only labels cached by the crawler are used, uploaded thumbnails are referenced by their file id.
+    :param message: Message to reply to
+    :param beers: Beers
+    :return: Beers without a cached label
+    """
+    labels = services.untappd.labels
+    if labels is None:
+        return beers
+
+    media = []
+    missing = []
+    for beer in beers:
+        photo = None
+        if beer.img:
+            photo = labels.file_id(beer.img) or labels.get(beer.img)
+        if photo is None:
+            missing.append(beer)
+        else:
+            media.append((beer, photo))
+
+    # Spread the photos evenly over the albums, so none is left with a single photo
+    albums = -(-len(media) // TelegramHttpsAPI.MEDIA_GROUP_MAX)
+    for i in range(albums):
+        album = media[i * len(media) // albums:(i + 1) * len(media) // albums]
+        file_ids = api.send_media_group(message.chat_id,
+                                        [(photo, str(beer)) for beer, photo in album],
+                                        reply_to=message.message_id,
+                                        parse_mode="Markdown")
+        for (beer, photo), file_id in zip(album, file_ids):
+            if file_id is not None and not isinstance(photo, str):
+                labels.set_file_id(beer.img, file_id)
+
+    return missing
+
+
 def handle_drink_request(message: Message, cmd_arr):
-    print("Handling drink addition")
+    log.debug("Handling drink addition")
     special_message_sent = False
     username = message.username
     user_id = message.user_id
+    stats = services.stats
+    drink_triggers = services.drink_triggers
 
     if username is not None and user_id is not None:
         for trigger in drink_triggers:
             if drink_triggers[trigger] in cmd_arr:
-                stats.add_drink(user_id, username, trigger)
+                stats.add_drink(message.chat_id, user_id, username, trigger)
                 if stats.send_special_reply(api, message, trigger): special_message_sent = True
 
         if not special_message_sent:
             reply = "*Kippis!* Juomia pudoteltu {} kpl, joista {} on nautittu tänään".format(
-                stats.get_total_drinks(telegram_id=user_id), stats.get_total_drinks_today(telegram_id=user_id))
+                stats.get_total_drinks(message.chat_id, telegram_id=user_id),
+                stats.get_total_drinks_today(message.chat_id, telegram_id=user_id))
 
             api.send_message(Message(chat_id=message.chat_id,
                                      reply_to=message.message_id,
                                      parse_mode="Markdown",
                                      text=reply))
     else:
-        print("Username or id missing from drink command!")
+        log.warning("Username or id missing from drink command!")
 
 
 def handle_drinking_records_request(message: Message, cmd_arr):
-    print("Getting drink stats")
+    log.debug("Getting drink stats")
 
-    total = False
-    extra_argument_idx = cmd_arr.index(triggers["drink_records"]) + 1
-    if len(cmd_arr) > extra_argument_idx:
-        if cmd_arr[extra_argument_idx].lower() == "total":
-            total = True
+    arguments = cmd_arr[cmd_arr.index(triggers["drink_records"]) + 1:]
+    total = "total" in arguments
 
     records = {}
+    stats = services.stats
+
+    if "chart" in arguments:
+        period = "week" if "week" in arguments else "day"
+        title = "{} - drinks per {}".format("Group" if total else message.username or message.user_id, period)
+        chart = stats.get_chart(message.chat_id, None if total else message.user_id, period, title)
+        if chart is None:
+            api.send_message(Message(chat_id=message.chat_id,
+                                     reply_to=message.message_id,
+                                     text="Chart not available right now"))
+            return
+        api.send_message(Message(chat_id=message.chat_id,
+                                 reply_to=message.message_id,
+                                 photo=chart))
+        return
 
     if total:
-        total = stats.get_total_drinks()
-        for drink in drink_triggers:
-            records[drink] = stats.get_total_drinks(drink_type=drink)
+        total = stats.get_total_drinks(message.chat_id)
+        for drink in services.drink_triggers:
+            records[drink] = stats.get_total_drinks(message.chat_id, drink_type=drink)
     else:
-        total = stats.get_total_drinks(telegram_id=message.user_id)
-        for drink in drink_triggers:
-            records[drink] = stats.get_total_drinks(drink_type=drink, telegram_id=message.user_id)
+        total = stats.get_total_drinks(message.chat_id, telegram_id=message.user_id)
+        for drink in services.drink_triggers:
+            records[drink] = stats.get_total_drinks(message.chat_id, drink_type=drink, telegram_id=message.user_id)
 
     reply = [f"Yhteensä *{total}* kpl juomia juotu:"]
 
-    print(reply)
-
     for drink in records:
         if records[drink] > 0:
             reply.append(f"- {drink}: {records[drink]} kpl")
 
-    print(reply)
+    api.send_message(Message(chat_id=message.chat_id,
+                             reply_to=message.message_id,
+                             parse_mode="Markdown",
+                             text="\n".join(reply)))
+
+
+def escape_markdown(text) -> str:
+    return re.sub(r"([_*`\[])", r"\\\1", str(text))
+
+
+def handle_leaderboard_request(message: Message, cmd_arr):
+    """
+    Replies with the top drinkers of the week, or of the month with a "month" argument.
+    A drink type argument limits the list to that drink.
+    :param message: Message to reply to
+    :param cmd_arr: Command split to words
+    :return: None
+    """
+    arguments = cmd_arr[cmd_arr.index(triggers["leaderboard"]) + 1:]
+    period = "month" if "month" in arguments else "week"
+    drink = next((i for i in arguments if i in services.drink_triggers), None)
+
+    leaders = services.stats.get_leaderboard(message.chat_id, period=period, drink_type=drink)
+    title = "Viikon" if period == "week" else "Kuukauden"
+    if drink is not None:
+        title += f" {drink}"
+    reply = [f"*{title} kovimmat:*"]
+    for i, (name, count) in enumerate(leaders):
+        reply.append(f"{i + 1}. {escape_markdown(name)}: {count} kpl")
+    if not leaders:
+        reply.append("Ei juomia vielä!")
 
     api.send_message(Message(chat_id=message.chat_id,
                              reply_to=message.message_id,
@@ -154,13 +350,103 @@ def handle_drinking_records_request(message: Message, cmd_arr):
                              text="\n".join(reply)))
 
 
-def build_beer_lists(lists: Dict):
+def handle_streak_request(message: Message):
     """
-    Initializes beer lists
+    Replies with the senders current and longest drinking streak
+    :param message: Message to reply to
+    :return: None
+    """
+    current, longest = services.stats.get_streak(message.chat_id, message.user_id)
+    api.send_message(Message(chat_id=message.chat_id,
+                             reply_to=message.message_id,
+                             parse_mode="Markdown",
+                             text=f"Putki käynnissä *{current}* päivää, pisin putki *{longest}* päivää"))
+
+
+def handle_hours_request(message: Message, cmd_arr):
+    """
+    Replies with a histogram of drinks by hour of day, group wide with a "total" argument
+    :param message: Message to reply to
+    :param cmd_arr: Command split to words
     :return: None
     """
-    untappd.set_beer_lists(lists)
+    if "total" in cmd_arr[cmd_arr.index(triggers["hours"]) + 1:]:
+        hours = services.stats.get_hour_histogram(message.chat_id)
+    else:
+        hours = services.stats.get_hour_histogram(message.chat_id, telegram_id=message.user_id)
+
+    peak = max(hours)
+    if peak == 0:
+        text = "Ei juomia vielä!"
+    else:
+        rows = ["{:02d} {:<15} {}".format(hour, "#" * max(1, round(15 * count / peak)), count)
+                for hour, count in enumerate(hours) if count > 0]
+        text = "```\n" + "\n".join(rows) + "\n```"
+
+    api.send_message(Message(chat_id=message.chat_id,
+                             reply_to=message.message_id,
+                             parse_mode="Markdown",
+                             text=text))
+
 
+def handle_profile_request(message: Message, cmd_arr):
+    """
+    Profiles the bot and replies with the report as a file. A number argument sets the profiling time in seconds.
+    :param message: Message to reply to
+    :param cmd_arr: Command split to words
+    :return: None
+    """
+    arguments = cmd_arr[cmd_arr.index(triggers["profile"]) + 1:]
+    seconds = Profiler.parse_seconds(next((i for i in arguments if re.fullmatch(r"\d+(\.\d+)?", i)), None),
+                                     profile_default_seconds, profile_max_seconds)
+    log.info("Profile requested", extra={"fields": {"user_id": message.user_id, "seconds": seconds}})
+    api.send_message(Message(chat_id=message.chat_id,
+                             reply_to=message.message_id,
+                             text="Profiling for {:g} s".format(seconds)))
+    report = Profiler.profile(seconds)
+    api.send_document(message.chat_id, time.strftime("profile-%Y%m%dT%H%M%S.txt"), report.encode("utf-8"),
+                      reply_to=message.message_id)
+
+
+def register_profiler_states():
+    """
+    Registers the thread pools, queues and subsystems reported by profiles
+    :return: None
+    """
+    Profiler.register_state("pool.handler", lambda: Profiler.executor_state(tpe))
+    Profiler.register_state("pool.inline", lambda: Profiler.executor_state(inline_tpe))
+    Profiler.register_state("pool.untappd_fetch", lambda: Profiler.executor_state(UntappdUtils.tpe))
+    Profiler.register_state("queue.log", lambda: {"queued": LogUtils.queue_size()})
+    Profiler.register_state("inline", lambda: {"lists": len(inline.lists), "snapshots": len(inline.snapshots),
+                                               "cached_answers": len(inline.answers)})
+
+    def untappd_state():
+        if not services.ready("untappd"):
+            return {"started": False}
+        untappd = services.untappd
+        now = time.time()
+        return {"refreshing": untappd.scheduler.refreshing,
+                "due_s": {list: round(due - now, 1) for list, due in untappd.scheduler.due.items()},
+                "parse_pool": Profiler.executor_state(untappd.crawler.parse_pool.executor)}
+
+    def charts_state():
+        if not services.ready("stats"):
+            return {"started": False}
+        charts = services.stats.charts
+        return {"cached": len(charts.charts), "pool": Profiler.executor_state(charts.pool.executor)}
+
+    Profiler.register_state("untappd", untappd_state)
+    Profiler.register_state("charts", charts_state)
+    for camera in cameras:
+        Profiler.register_state("camera." + camera, lambda camera=camera: services.get("cam_" + camera).state()
+                                if services.ready("cam_" + camera) else {"started": False})
+
+
+def build_beer_lists(lists: Dict):
+    """
+    Initializes beer list commands
+    :return: None
+    """
     for list in lists:
         beer_tap_triggers.append("/" + list)
 
@@ -175,42 +461,104 @@ def send_banhammer(message: Message):
                                   "ympäri sinua ja hukutan sinut siihen."))
 
 
+def report_startup():
+    """
+    Logs the initialization times once all subsystems are up or have failed
+    :return: None
+    """
+    names = ["stats", "untappd"] + ["cam_" + camera for camera in cameras]
+    for name in names:
+        while not services.ready(name) and not services.failed(name):
+            time.sleep(0.1)
+    fields = {k: "{:.3f}".format(v) for k, v in services.startup_report().items()}
+    failed = [name for name in names if services.failed(name)]
+    if failed:
+        log.warning("Startup complete with failed subsystems", extra={"fields": {**fields, "failed": ",".join(failed)}})
+    else:
+        log.info("Startup complete", extra={"fields": fields})
+
+
+def shutdown():
+    """
+    Stops the camera workers so their shared memory is released
+    :return: None
+    """
+    for camera in cameras:
+        if services.ready("cam_" + camera):
+            services.get("cam_" + camera).stop()
+    LogUtils.stop_logging()
+
+
 def main():
-    build_beer_lists({"hana": "https://untappd.com/v/pub-kultainen-apina/17995?ng_menu_id=5035026b-1470-48c7"
-                              "-b82a-bf1df18f5889"})
-    untappd.start()
+    init()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    for venue in venues.values():
+        build_beer_lists(venue["lists"])
+    register_profiler_states()
+    if metrics_port is not None:
+        Metrics.register_route("/debug/profile", lambda parameters: Profiler.handle_profile_request(
+            parameters, profile_default_seconds, profile_max_seconds))
+        Metrics.start_http_server(metrics_port)
+
+    # Start answering right away, subsystems come up in the background
+    services.warm_up()
+    threading.Thread(target=report_startup, daemon=True).start()
+    Metrics.startup_time.set(time.perf_counter() - process_start, "polling")
+
+    try:
+        poll()
+    finally:
+        shutdown()
+
+
+def poll():
     while True:
         try:
             messages = api.get_messages()
             for message in messages:
+                if isinstance(message, InlineQuery):
+                    submit("inline", handle_inline_query, message, pool=inline_tpe)
+                    continue
 
                 text = message.text.lower()
                 cmd_arr = re.split(r"[@ ]", text)
                 beer_list_cmds = [i for i in cmd_arr if i in beer_tap_triggers]
-                drink_cmd_found = any([i for i in cmd_arr if i in drink_triggers.values()])
+                camera_cmds = [i for i in cmd_arr if i in camera_triggers]
+                drink_cmd_found = any([i for i in cmd_arr if i in services.drink_triggers.values()])
 
                 # Blacklist checks
                 allowed = True
                 if message.username in blacklist:
                     if any([i for i in cmd_arr if i in blacklist[message.username]]):
-                        tpe.submit(send_banhammer, message)
+                        submit("banhammer", send_banhammer, message)
                         allowed = False
 
                 if allowed:
-                    if triggers["image"] in cmd_arr:
-                        tpe.submit(handle_image_request, message)
+                    if len(camera_cmds) > 0:
+                        submit("image", handle_image_request, message, camera_triggers[camera_cmds[0]], cmd_arr)
                     if triggers["help"] in cmd_arr:
-                        tpe.submit(handle_help_request, message)
+                        submit("help", handle_help_request, message)
                     if drink_cmd_found:
-                        tpe.submit(handle_drink_request, message, cmd_arr)
+                        submit("drink", handle_drink_request, message, cmd_arr)
                     if triggers["drink_records"] in cmd_arr:
-                        tpe.submit(handle_drinking_records_request, message, cmd_arr)
+                        submit("drink_records", handle_drinking_records_request, message, cmd_arr)
+                    if triggers["leaderboard"] in cmd_arr:
+                        submit("leaderboard", handle_leaderboard_request, message, cmd_arr)
+                    if triggers["streak"] in cmd_arr:
+                        submit("streak", handle_streak_request, message)
+                    if triggers["hours"] in cmd_arr:
+                        submit("hours", handle_hours_request, message, cmd_arr)
+                    if triggers["profile"] in cmd_arr and message.user_id in admins:
+                        submit("profile", handle_profile_request, message, cmd_arr, pool=profile_tpe)
                     if len(beer_list_cmds) > 0:
-                        tpe.submit(handle_beer_tap_request, message, beer_list_cmds[0][1:])
-        except Exception as e:
-            print("Major oops")
-            print(e)
+                        words = text.split()[1:]
+                        query = [word for word in words if word != beer_labels_keyword]
+                        submit("beer_tap", handle_beer_tap_request, message, beer_list_cmds[0][1:],
+                               query, len(query) < len(words))
+        except Exception:
+            log.exception("Major oops")
             continue
 
 
-main()
+if __name__ == "__main__":
+    main()
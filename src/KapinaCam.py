@@ -1,102 +1,480 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import time
+"""
+Camera capture and snapshot processing run in a dedicated worker process per camera, so OpenCV work never competes
+with the bot's own threads for the GIL.
+
+The worker publishes the latest raw frame and the latest encoded JPEG of each snapshot variant in shared memory.
+The buffers are guarded by sequence counters (seqlock): the writer makes the counter odd while writing and even when
+done, and readers retry if the counter changed during their read. The bot process supervises the worker through a
+heartbeat and restarts it if the camera device hangs.
+
+Snapshots come in variants of different size (e.g. thumbnail, standard and full), each with a byte budget. The JPEG
+quality of a variant is searched to get as close under the budget as possible, starting from the quality that fit
+last time, so the upload over a slow uplink stays predictable.
+"""
+
+import os
+import struct
 import threading
-import cv2
-import numpy as np
+import time
+from bisect import bisect_left
+from multiprocessing import shared_memory
+from typing import Dict, List
+
+import Metrics
+import LogUtils
+from WorkerPool import spawn_context
+
+log = LogUtils.get_logger("KapinaCam")
+
+# Seqlock read attempts before giving up
+READ_ATTEMPTS = 1000
+# Consecutive failed frame reads before the worker exits to get the device re-opened
+READ_FAILURE_LIMIT = 20
+# Seconds before restarting a dead or hung worker, doubled on every restart until a frame is captured again
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+
+# Capture times are counted into the buckets of the capture histogram by the worker, and the supervisor adds the
+# new counts to the histogram, so every capture is recorded
+CAPTURE_BUCKETS = Metrics.camera_capture.buckets
+
+# Control block fields. Each field is written by one side only: the snapshot request counter and the requested
+# variant by the bot, everything else by the worker.
+FIELDS = [("raw_seq", "Q"), ("height", "I"), ("width", "I"), ("channels", "I"),
+          ("requests", "Q"), ("served", "Q"), ("variant", "I"),
+          ("heartbeat", "d"), ("capture_s", "d")]
+FIELDS += [("capture_count_{}".format(i), "Q") for i in range(len(CAPTURE_BUCKETS) + 1)] + [("capture_sum", "d")]
+RAW_SEQ, HEIGHT, WIDTH, CHANNELS, REQUESTS, SERVED, VARIANT, HEARTBEAT, CAPTURE_S = range(9)
+# Capture count of each histogram bucket and +Inf, sum of the capture times
+CAPTURE_COUNTS = range(9, 9 + len(CAPTURE_BUCKETS) + 1)
+CAPTURE_SUM = CAPTURE_COUNTS.stop
+
+# Fields of each variant's snapshot slot, written by the worker, following the control fields
+SLOT_FIELDS = [("jpeg_seq", "Q"), ("jpeg_len", "I"), ("quality", "I"), ("encode_s", "d")]
+JPEG_SEQ, JPEG_LEN, QUALITY, ENCODE_S = range(4)
+
+MAX_FRAME_BYTES = 1920 * 1080 * 3
+MAX_JPEG_BYTES = 4 * 1024 * 1024
+
+# Output scale relative to the zoomed crop, JPEG byte budget and quality bounds
+DEFAULT_VARIANTS = {"thumb": {"scale": 0.4, "budget": 20 * 1024},
+                    "standard": {"scale": 0.75, "budget": 80 * 1024},
+                    "hd": {"scale": 1.0, "budget": 300 * 1024, "max_quality": 95}}
+MIN_QUALITY = 30
+MAX_QUALITY = 90
+# Encodes landing within this fraction of the budget are accepted without searching further
+BUDGET_FILL = 0.85
+MAX_ENCODE_ATTEMPTS = 6
+
+
+def _layout(fields):
+    """
+    :return: Struct of the fields and (struct, offset) of each field
+    """
+    layout = []
+    for i, (_, fmt) in enumerate(fields):
+        layout.append((struct.Struct("<" + fmt), struct.calcsize("<" + "".join(f for _, f in fields[:i]))))
+    return struct.Struct("<" + "".join(fmt for _, fmt in fields)), layout
+
+
+CONTROL, FIELD_STRUCTS = _layout(FIELDS)
+SLOT, SLOT_STRUCTS = _layout(SLOT_FIELDS)
+
+
+class _Control:
+    """
+    Typed access to the control block
+    """
+
+    def __init__(self, buf):
+        self.buf = buf
+
+    def read(self):
+        return CONTROL.unpack_from(self.buf, 0)
+
+    def set(self, field, value):
+        fmt, offset = FIELD_STRUCTS[field]
+        fmt.pack_into(self.buf, offset, value)
+
+    def get(self, field):
+        fmt, offset = FIELD_STRUCTS[field]
+        return fmt.unpack_from(self.buf, offset)[0]
+
+    def read_slot(self, slot):
+        return SLOT.unpack_from(self.buf, CONTROL.size + slot * SLOT.size)
+
+    def set_slot(self, slot, field, value):
+        fmt, offset = SLOT_STRUCTS[field]
+        fmt.pack_into(self.buf, CONTROL.size + slot * SLOT.size + offset, value)
+
+    def get_slot(self, slot, field):
+        fmt, offset = SLOT_STRUCTS[field]
+        return fmt.unpack_from(self.buf, CONTROL.size + slot * SLOT.size + offset)[0]
+
+
+def _encode(cv2, image, variant: Dict, params: List[int], quality: int):
+    """
+    Encodes an image with the highest quality that fits the variant's byte budget
+    :param cv2: OpenCV module
+    :param image: Image
+    :param variant: Variant settings
+    :param params: Extra cv2.imencode parameters
+    :param quality: Quality to try first
+    :return: (JPEG array, quality), None if encoding failed
+    """
+    budget = variant["budget"]
+    low = variant.get("min_quality", MIN_QUALITY)
+    high = variant.get("max_quality", MAX_QUALITY)
+    quality = min(max(quality, low), high)
+
+    best = smallest = None
+    for _ in range(MAX_ENCODE_ATTEMPTS):
+        ok, jpeg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, quality] + params)
+        if not ok:
+            return None
+        if len(jpeg) <= budget:
+            best = (jpeg, quality)
+            if len(jpeg) >= BUDGET_FILL * budget:
+                break
+            low = quality + 1
+        else:
+            smallest = (jpeg, quality)
+            high = quality - 1
+        if low > high:
+            break
+        quality = (low + high) // 2
+
+    # Over the budget even at the lowest quality, send the smallest one anyway
+    return best or smallest
+
+
+def _camera_worker(parent_pid, names, camera_id, settings):
+    """
+    Worker process main loop. Captures frames continuously and encodes a snapshot whenever one is requested.
+    :param parent_pid: Bot process id, the worker exits if the bot goes away
+    :param names: Shared memory names (control, raw frame, jpeg)
+    :param camera_id: Device index or path for cv2.VideoCapture, or a callable returning a capture-like object
+    :param settings: Snapshot processing and logging settings
+    :return: None
+    """
+    import cv2
+    import numpy as np
+
+    LogUtils.setup_logging(settings["log_levels"], settings["log_sampling"])
+    ctl_shm, raw_shm, jpeg_shm = [shared_memory.SharedMemory(name=name) for name in names]
+    ctl = _Control(ctl_shm.buf)
+
+    cap = camera_id() if callable(camera_id) else cv2.VideoCapture(camera_id)
+    cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
+    cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+    unsharp_kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+    y_crop, x_crop = settings["y_crop"], settings["x_crop"]
+    variants = settings["variants"]
+    params = []
+    if settings["progressive"]:
+        params += [cv2.IMWRITE_JPEG_PROGRESSIVE, 1]
+    if settings["optimize"]:
+        params += [cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+
+    # A previous worker may have been killed in the middle of a write
+    if ctl.get(RAW_SEQ) % 2:
+        ctl.set(RAW_SEQ, ctl.get(RAW_SEQ) + 1)
+    for slot in range(len(variants)):
+        if ctl.get_slot(slot, JPEG_SEQ) % 2:
+            ctl.set_slot(slot, JPEG_SEQ, ctl.get_slot(slot, JPEG_SEQ) + 1)
+
+    frame = None
+    last_capture = 0.0
+    failures = 0
+    while os.getppid() == parent_pid:
+        ctl.set(HEARTBEAT, time.time())
+
+        now = time.time()
+        if now - last_capture >= settings["capture_interval"]:
+            start = time.perf_counter()
+            ret, new_frame = cap.read()
+            capture_time = time.perf_counter() - start
+            last_capture = now
+            if ret and new_frame is not None and new_frame.nbytes <= MAX_FRAME_BYTES:
+                if failures:
+                    log.info("Camera read recovered", extra={"fields": {"failures": failures}})
+                    failures = 0
+                frame = new_frame
+                seq = ctl.get(RAW_SEQ)
+                ctl.set(RAW_SEQ, seq + 1)
+                np.ndarray(frame.shape, dtype=np.uint8, buffer=raw_shm.buf)[:] = frame
+                for field, value in zip((HEIGHT, WIDTH, CHANNELS), frame.shape):
+                    ctl.set(field, value)
+                ctl.set(CAPTURE_S, capture_time)
+                ctl.set(RAW_SEQ, seq + 2)
+                bucket = CAPTURE_COUNTS[bisect_left(CAPTURE_BUCKETS, capture_time)]
+                ctl.set(bucket, ctl.get(bucket) + 1)
+                ctl.set(CAPTURE_SUM, ctl.get(CAPTURE_SUM) + capture_time)
+            else:
+                failures += 1
+                if failures == 1:
+                    log.warning("Camera read failed")
+                if failures >= READ_FAILURE_LIMIT:
+                    # The supervisor restarts the worker, which opens the device again
+                    log.error("Camera read keeps failing, exiting", extra={"fields": {"failures": failures}})
+                    cap.release()
+                    LogUtils.stop_logging()
+                    return
+
+        requests = ctl.get(REQUESTS)
+        if frame is not None and ctl.get(SERVED) < requests:
+            start = time.perf_counter()
+            slot = ctl.get(VARIANT)
+            variant = variants[slot]
+
+            # Cropping
+            out = frame[y_crop[0]:y_crop[1], x_crop[0]:x_crop[1]]
+
+            # Resizing, zoom and variant scale in one go
+            scale = settings["zoom_factor"] * variant["scale"]
+            w = max(1, int(out.shape[1] * scale))
+            h = max(1, int(out.shape[0] * scale))
+            out = cv2.resize(out, (w, h), interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+
+            # Sharpening (Using convolution magic and unsharp mask (USM) technique)
+            if settings["sharpen"]:
+                out = cv2.filter2D(out, -1, unsharp_kernel)
+
+            encoded = _encode(cv2, out, variant, params, ctl.get_slot(slot, QUALITY) or MAX_QUALITY)
+            if encoded is not None and len(encoded[0]) <= MAX_JPEG_BYTES:
+                jpeg, quality = encoded
+                offset = slot * MAX_JPEG_BYTES
+                seq = ctl.get_slot(slot, JPEG_SEQ)
+                ctl.set_slot(slot, JPEG_SEQ, seq + 1)
+                jpeg_shm.buf[offset:offset + len(jpeg)] = jpeg.tobytes()
+                ctl.set_slot(slot, JPEG_LEN, len(jpeg))
+                ctl.set_slot(slot, QUALITY, quality)
+                ctl.set_slot(slot, ENCODE_S, time.perf_counter() - start)
+                ctl.set_slot(slot, JPEG_SEQ, seq + 2)
+            ctl.set(SERVED, requests)
+            continue
+
+        time.sleep(0.01)
 
 
 class KapinaCam:
     """
     Abstraction for attached camera equipment.
-    Due to silly buffering of webcam hardware and openCV the camera is constantly running in the background.
-    Snapshots are only saved when instructed to do so.
+    Due to silly buffering of webcam hardware and openCV the camera is constantly running in the background,
+    in its own process. Snapshots are only processed when instructed to do so.
 
-    A minimum interval can be set to avoid saving snapshots too rapidly.
+    A minimum interval can be set to avoid processing snapshots too rapidly, the previous snapshot of the same
+    variant is returned in between.
     """
     def __init__(self,
-                 write_sem,
-                 output_file,
                  camera_id=0,
                  capture_interval=0.5,
                  min_save_interval=1,
                  y_crop=(233, 520),
                  x_crop=(632, 1042),
                  zoom_factor=2,
-                 sharpen=True):
+                 sharpen=True,
+                 variants: Dict[str, Dict] = None,
+                 default_variant="standard",
+                 progressive=False,
+                 optimize=True,
+                 hang_timeout=10,
+                 snapshot_timeout=5,
+                 log_levels: Dict[str, str] = None,
+                 log_sampling: Dict[str, int] = None):
         """
         Holy shit this is a lot of parameters
-        :param write_sem:
-        :param output_file:
-        :param camera_id:
-        :param capture_interval:
-        :param min_save_interval:
-        :param y_crop:
-        :param x_crop:
-        :param zoom_factor:
-        :param sharpen:
+        :param camera_id: Device index or path for cv2.VideoCapture, or a callable returning a capture-like object
+        :param capture_interval: Seconds between frame reads
+        :param min_save_interval: Minimum seconds between processed snapshots of a variant
+        :param y_crop: Vertical crop range
+        :param x_crop: Horizontal crop range
+        :param zoom_factor: Scale factor after cropping
+        :param sharpen: Apply unsharp mask
+        :param variants: Dict["Variant name": {"scale": output scale after zoom, "budget": JPEG bytes,
+                                               optional "min_quality" and "max_quality"}], see DEFAULT_VARIANTS
+        :param default_variant: Variant of snapshots requested without one
+        :param progressive: Encode progressive JPEGs
+        :param optimize: Optimize JPEG Huffman tables, slightly smaller files for a little more encoding time
+        :param hang_timeout: Seconds without a worker heartbeat before the worker is restarted
+        :param snapshot_timeout: Seconds to wait for a requested snapshot
+        :param log_levels: Log levels per module name in the worker process
+        :param log_sampling: Sampling rates per sample key in the worker process
         """
-
-        self.cap = cv2.VideoCapture(camera_id)
-        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
-        self.capture_interval = capture_interval
-
-        self.output_file = output_file
+        self.camera_id = camera_id
+        variants = variants if variants is not None else DEFAULT_VARIANTS
+        self.variants = list(variants)
+        self.default_variant = default_variant if default_variant in variants else self.variants[0]
+        self.settings = {"capture_interval": capture_interval,
+                         "y_crop": y_crop,
+                         "x_crop": x_crop,
+                         "zoom_factor": zoom_factor,
+                         "sharpen": sharpen,
+                         "variants": list(variants.values()),
+                         "progressive": progressive,
+                         "optimize": optimize,
+                         "log_levels": log_levels,
+                         "log_sampling": log_sampling}
         self.min_save_interval = min_save_interval
-        self.y_crop = y_crop
-        self.x_crop = x_crop
-        self.zoom_factor = zoom_factor
-        self.sharpen = sharpen
+        self.hang_timeout = hang_timeout
+        self.snapshot_timeout = snapshot_timeout
 
-        self.write_sem: threading.Semaphore = write_sem
-        self.elapsed = min_save_interval
-        self.start = 0
+        self.ctl_shm = shared_memory.SharedMemory(create=True, size=CONTROL.size + SLOT.size * len(self.variants))
+        self.raw_shm = shared_memory.SharedMemory(create=True, size=MAX_FRAME_BYTES)
+        self.jpeg_shm = shared_memory.SharedMemory(create=True, size=MAX_JPEG_BYTES * len(self.variants))
+        self.ctl = _Control(self.ctl_shm.buf)
+        self.ctl_shm.buf[:] = bytes(self.ctl_shm.size)
 
-        self.camera_sem = threading.Semaphore(1)
-        self.frame = None
+        self.mp = spawn_context()
+        self.process = None
+        self.request_lock = threading.Lock()
+        self.last_snapshot = [0] * len(self.variants)
+        self.stopped = False
 
-        self.unsharp_kernel = np.array([[-1, -1, -1], [-1, 9, -1], [-1, -1, -1]])
+        self.__start_worker()
+        threading.Thread(target=self.supervise, name="camera-supervisor", daemon=True).start()
 
-        threading.Thread(target=self.videocapture).start()
+    def __start_worker(self):
+        self.ctl.set(HEARTBEAT, time.time())
+        self.process = self.mp.Process(target=_camera_worker,
+                                       args=(os.getpid(),
+                                             (self.ctl_shm.name, self.raw_shm.name, self.jpeg_shm.name),
+                                             self.camera_id, self.settings),
+                                       daemon=True)
+        self.process.start()
+        log.info("Camera worker started", extra={"fields": {"pid": self.process.pid}})
 
-    def videocapture(self):
+    def supervise(self):
         """
-        Continuously reads camera output and updates the buffer frame of this instance
+        Restarts the worker process if it dies or stops sending heartbeats. Restarts back off exponentially
+        until the worker captures a frame again.
         :return: None
         """
-        while True:
-            with self.camera_sem:
-                ret, self.frame = self.cap.read()
-            time.sleep(self.capture_interval)
+        raw_seq = 0
+        restart_delay = RESTART_DELAY
+        captures = [0] * len(CAPTURE_COUNTS)
+        capture_sum = 0.0
+        while not self.stopped:
+            time.sleep(1)
+            fields = self.ctl.read()
+            if fields[RAW_SEQ] != raw_seq:
+                raw_seq = fields[RAW_SEQ]
+                restart_delay = RESTART_DELAY
+                counts = fields[CAPTURE_COUNTS.start:CAPTURE_COUNTS.stop]
+                Metrics.camera_capture.add([new - old for new, old in zip(counts, captures)],
+                                           fields[CAPTURE_SUM] - capture_sum)
+                captures, capture_sum = counts, fields[CAPTURE_SUM]
+            stale = time.time() - fields[HEARTBEAT] > self.hang_timeout
+            if not self.stopped and (stale or not self.process.is_alive()):
+                log.warning("Camera worker hung or died, restarting",
+                            extra={"fields": {"pid": self.process.pid, "exitcode": self.process.exitcode,
+                                              "delay_s": restart_delay}})
+                self.process.kill()
+                self.process.join(5)
+                for _ in range(restart_delay):
+                    if self.stopped:
+                        return
+                    time.sleep(1)
+                restart_delay = min(restart_delay * 2, MAX_RESTART_DELAY)
+                self.__start_worker()
+
+    def __read_jpeg(self, slot):
+        """
+        Reads the latest snapshot of a variant
+        :param slot: Variant index
+        :return: JPEG bytes, None if there is none yet
+        """
+        offset = slot * MAX_JPEG_BYTES
+        for _ in range(READ_ATTEMPTS):
+            seq = self.ctl.get_slot(slot, JPEG_SEQ)
+            if seq == 0:
+                return None
+            if seq % 2:
+                time.sleep(0.001)
+                continue
+            length = self.ctl.get_slot(slot, JPEG_LEN)
+            data = bytes(self.jpeg_shm.buf[offset:offset + length])
+            if self.ctl.get_slot(slot, JPEG_SEQ) == seq:
+                return data
+        return None
+
+    def latest_frame(self):
+        """
+        Returns a copy of the latest raw frame
+        :return: numpy array, None if no frame has been captured yet
+        """
+        import numpy as np
+
+        for _ in range(READ_ATTEMPTS):
+            fields = self.ctl.read()
+            seq = fields[RAW_SEQ]
+            if seq == 0:
+                return None
+            if seq % 2:
+                time.sleep(0.001)
+                continue
+            shape = (fields[HEIGHT], fields[WIDTH], fields[CHANNELS])
+            frame = np.ndarray(shape, dtype=np.uint8, buffer=self.raw_shm.buf).copy()
+            if self.ctl.get(RAW_SEQ) == seq:
+                return frame
+        return None
+
+    def snapshot(self, variant: str = None):
+        """
+        Returns a processed snapshot of the current frame. If the minimum interval has not elapsed since
+        the last processed snapshot of the variant, the last one is returned instead.
+        :param variant: Variant name, defaults to the default variant
+        :return: JPEG bytes, None if no snapshot could be taken
+        """
+        slot = self.variants.index(variant if variant in self.variants else self.default_variant)
+        with self.request_lock:
+            if time.time() - self.last_snapshot[slot] >= self.min_save_interval:
+                self.last_snapshot[slot] = time.time()
+                self.ctl.set(VARIANT, slot)
+                request = self.ctl.get(REQUESTS) + 1
+                self.ctl.set(REQUESTS, request)
+                deadline = time.time() + self.snapshot_timeout
+                while self.ctl.get(SERVED) < request:
+                    if time.time() > deadline:
+                        log.warning("Snapshot timed out")
+                        break
+                    time.sleep(0.005)
+                else:
+                    _, length, quality, encode_s = self.ctl.read_slot(slot)
+                    name = self.variants[slot]
+                    Metrics.camera_encode.observe(encode_s, name)
+                    Metrics.camera_jpeg_bytes.observe(length, name)
+                    log.debug("Snapshot encoded", extra={"fields": {"variant": name, "bytes": length,
+                                                                    "quality": quality}})
+
+        return self.__read_jpeg(slot)
+
+    def state(self) -> Dict:
+        """
+        Describes the worker process and the latest snapshots, for diagnostics
+        :return: State dict
+        """
+        fields = self.ctl.read()
+        return {"pid": self.process.pid,
+                "alive": self.process.is_alive(),
+                "heartbeat_age_s": round(time.time() - fields[HEARTBEAT], 2),
+                "capture_s": round(fields[CAPTURE_S], 4),
+                "requests": fields[REQUESTS],
+                "served": fields[SERVED],
+                "variants": {name: dict(zip(("bytes", "quality", "encode_s"), self.ctl.read_slot(slot)[1:]))
+                             for slot, name in enumerate(self.variants)}}
 
-    def snapshot(self):
+    def stop(self):
         """
-        Saves the current buffer frame to file if given minimum interval has elapsed from last save
+        Stops the worker and releases the shared memory
         :return: None
         """
-        self.elapsed = time.time() - self.start
-        if self.elapsed < self.min_save_interval:
-            return
-
-        self.start = time.time()
-
-        with self.camera_sem:
-            frame = self.frame
-        # Cropping
-        frame = frame[self.y_crop[0]:self.y_crop[1], self.x_crop[0]:self.x_crop[1]]
-
-        # Resizing
-        w = int(frame.shape[1] * self.zoom_factor)
-        h = int(frame.shape[0] * self.zoom_factor)
-        dim = (w, h)
-        frame = cv2.resize(frame, dim)
-
-        # Sharpening (Using convolution magic and unsharp mask (USM) technique)
-        if self.sharpen:
-            frame = cv2.filter2D(frame, -1, self.unsharp_kernel)
-
-        with self.write_sem:
-            print("Saved picture")
-            cv2.imwrite(self.output_file, frame)
+        self.stopped = True
+        self.process.kill()
+        self.process.join(5)
+        for shm in (self.ctl_shm, self.raw_shm, self.jpeg_shm):
+            shm.close()
+            shm.unlink()
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Beer label thumbnails.
+
+Labels are downloaded and shrunk during the background crawl and kept in a bounded least recently used cache on
+disk, with the most recently used thumbnails also held in memory. Telegram file ids of uploaded thumbnails are
+remembered alongside, so each label is uploaded once and referenced by id after that.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import Metrics
+import LogUtils
+
+log = LogUtils.get_logger("LabelCache")
+
+
+class LabelCache:
+    """
+    Bounded LRU cache of label thumbnails keyed by label URL
+    """
+
+    FILE_IDS = "file_ids.json"
+
+    def __init__(self, directory, max_entries=500, memory_entries=100, size=320, quality=85):
+        """
+        :param directory: Cache directory, created if missing
+        :param max_entries: Maximum number of thumbnails on disk
+        :param memory_entries: Maximum number of thumbnails in memory
+        :param size: Longest side of a thumbnail in pixels
+        :param quality: JPEG quality of the thumbnails
+        """
+        self.directory = directory
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.size = size
+        self.quality = quality
+        self.lock = threading.Lock()
+        # key -> JPEG bytes, least recently used first
+        self.memory = OrderedDict()
+        # keys on disk, least recently used first
+        self.disk = OrderedDict()
+
+        os.makedirs(directory, exist_ok=True)
+        entries = [e for e in os.scandir(directory) if e.name.endswith(".jpg")]
+        for entry in sorted(entries, key=lambda e: e.stat().st_mtime):
+            self.disk[entry.name[:-4]] = None
+
+        self.file_ids = {}
+        try:
+            with open(os.path.join(directory, LabelCache.FILE_IDS), "r") as f:
+                self.file_ids = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+        with self.lock:
+            self.__evict()
+
+    @staticmethod
+    def key(url: str) -> str:
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def __path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".jpg")
+
+    def __contains__(self, url: str) -> bool:
+        return LabelCache.key(url) in self.disk
+
+    def __touch(self, key: str):
+        """
+        Marks an entry used, also on disk so the order survives restarts. Caller holds the lock.
+        """
+        self.disk.move_to_end(key)
+        try:
+            os.utime(self.__path(key))
+        except OSError:
+            pass
+
+    def __evict(self):
+        """
+        Drops least recently used entries over the limits. Caller holds the lock.
+        """
+        while len(self.memory) > self.memory_entries:
+            self.memory.popitem(last=False)
+
+        evicted = False
+        while len(self.disk) > self.max_entries:
+            key, _ = self.disk.popitem(last=False)
+            self.memory.pop(key, None)
+            evicted = self.file_ids.pop(key, None) is not None or evicted
+            try:
+                os.remove(self.__path(key))
+            except OSError:
+                pass
+        if evicted:
+            self.__save_file_ids()
+
+    def __save_file_ids(self):
+        """
+        Caller holds the lock
+        """
+        path = os.path.join(self.directory, LabelCache.FILE_IDS)
+        try:
+            with open(path + ".tmp", "w") as f:
+                json.dump(self.file_ids, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            log.warning("Saving label file ids failed", extra={"fields": {"error": e}})
+
+    def thumbnail(self, image: bytes) -> Optional[bytes]:
+        """
+        Shrinks an image to a JPEG thumbnail
+        :param image: Encoded image
+        :return: JPEG bytes, None if the image could not be decoded
+        """
+        import cv2
+        import numpy as np
+
+        img = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        scale = self.size / max(img.shape[:2])
+        if scale < 1:
+            img = cv2.resize(img, (max(1, round(img.shape[1] * scale)), max(1, round(img.shape[0] * scale))),
+                             interpolation=cv2.INTER_AREA)
+        ok, jpeg = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        return jpeg.tobytes() if ok else None
+
+    def put(self, url: str, image: bytes) -> bool:
+        """
+        Stores the thumbnail of a label
+        :param url: Label URL
+        :param image: Encoded label image
+        :return: True if stored
+        """
+        thumbnail = self.thumbnail(image)
+        if thumbnail is None:
+            log.warning("Label could not be decoded", extra={"fields": {"url": url}})
+            return False
+
+        key = LabelCache.key(url)
+        with self.lock:
+            try:
+                with open(self.__path(key), "wb") as f:
+                    f.write(thumbnail)
+            except OSError as e:
+                log.warning("Storing label failed", extra={"fields": {"url": url, "error": e}})
+                return False
+            self.disk[key] = None
+            self.disk.move_to_end(key)
+            self.memory[key] = thumbnail
+            self.memory.move_to_end(key)
+            self.__evict()
+        return True
+
+    def fetch(self, url: str, download: Callable[[str], Optional[bytes]]) -> bool:
+        """
+        Makes sure a label is cached, downloading it if needed
+        :param url: Label URL
+        :param download: Function returning the label image from its URL, None if failed
+        :return: True if the label is cached
+        """
+        key = LabelCache.key(url)
+        with self.lock:
+            if key in self.disk:
+                self.__touch(key)
+                return True
+
+        Metrics.label_cache.inc("download")
+        image = download(url)
+        return image is not None and self.put(url, image)
+
+    def get(self, url: str) -> Optional[bytes]:
+        """
+        Returns a cached thumbnail. Never downloads anything.
+        :param url: Label URL
+        :return: JPEG bytes, None if not cached
+        """
+        key = LabelCache.key(url)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.__touch(key)
+                Metrics.label_cache.inc("memory")
+                return self.memory[key]
+            if key not in self.disk:
+                Metrics.label_cache.inc("miss")
+                return None
+
+            try:
+                with open(self.__path(key), "rb") as f:
+                    thumbnail = f.read()
+            except OSError:
+                del self.disk[key]
+                Metrics.label_cache.inc("miss")
+                return None
+            self.__touch(key)
+            self.memory[key] = thumbnail
+            self.__evict()
+            Metrics.label_cache.inc("disk")
+            return thumbnail
+
+    def file_id(self, url: str) -> Optional[str]:
+        """
+        :param url: Label URL
+        :return: Telegram file id of the uploaded thumbnail, None if not uploaded yet
+        """
+        key = LabelCache.key(url)
+        with self.lock:
+            file_id = self.file_ids.get(key)
+            if file_id is not None and key in self.disk:
+                self.__touch(key)
+                Metrics.label_cache.inc("file_id")
+            return file_id
+
+    def set_file_id(self, url: str, file_id: str):
+        """
+        Remembers the Telegram file id of an uploaded thumbnail
+        :param url: Label URL
+        :param file_id: Telegram file id
+        :return: None
+        """
+        key = LabelCache.key(url)
+        with self.lock:
+            if key in self.disk and self.file_ids.get(key) != file_id:
+                self.file_ids[key] = file_id
+                self.__save_file_ids()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Non-blocking structured logging.
+
+Log records are put to a bounded in-memory queue and written out by a single background thread, so the threads
+handling requests never wait on stdout/journald. When the queue is full new records are dropped and counted instead.
+Records are written in logfmt (key=value) form, extra fields can be attached with extra={"fields": {...}}.
+"""
+
+import logging
+import queue
+import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict
+
+import Metrics
+
+log_dropped = Metrics.Counter("kapinabot_log_dropped_total", "Log records dropped due to a full log queue")
+
+_listener = None
+
+
+def get_logger(name: str) -> logging.Logger:
+    """
+    Returns the logger of a module
+    :param name: Module name
+    :return: Logger
+    """
+    return logging.getLogger(name)
+
+
+def _quote(value) -> str:
+    value = str(value)
+    if value == "" or any(c in value for c in ' ="\n'):
+        return '"' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+    return value
+
+
+class LogfmtFormatter(logging.Formatter):
+    """
+    Formats records as logfmt lines.
+    Tracebacks are already folded into the message by QueueHandler.prepare.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        parts = ["level=" + record.levelname,
+                 "module=" + record.name,
+                 "thread=" + _quote(record.threadName),
+                 "msg=" + _quote(record.getMessage())]
+        fields = getattr(record, "fields", None)
+        if fields:
+            parts.extend("{}={}".format(k, _quote(v)) for k, v in fields.items())
+        return " ".join(parts)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes only every Nth record of a noisy message.
+    Records are tagged for sampling with extra={"sample": "key"}, the rate of each key is configured separately.
+    """
+
+    def __init__(self, rates: Dict[str, int]):
+        super().__init__()
+        self.rates = rates
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        rate = self.rates.get(key, 1) if key is not None else 1
+        if rate <= 1:
+            return True
+        with self.lock:
+            count = self.counts.get(key, 0)
+            self.counts[key] = count + 1
+        return count % rate == 0
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks the caller
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_dropped.inc()
+
+
+def setup_logging(levels: Dict[str, str] = None,
+                  sampling: Dict[str, int] = None,
+                  default_level="INFO",
+                  queue_size=10000,
+                  stream=sys.stdout):
+    """
+    Routes all logging through the background writer thread
+    :param levels: Log levels per module name
+    :param sampling: Sampling rates per sample key
+    :param default_level: Level of modules not listed in levels
+    :param queue_size: Maximum number of pending records
+    :param stream: Output stream
+    :return: None
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sampling or {}))
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(LogfmtFormatter())
+
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(default_level)
+    for name, level in (levels or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """
+    Flushes pending records and stops the writer thread
+    :return: None
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def queue_size() -> int:
+    """
+    :return: Number of records waiting for the writer thread
+    """
+    listener = _listener
+    return listener.queue.qsize() if listener is not None else 0
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Lightweight instrumentation for the bot.
+
+Metrics are kept in process memory and exposed in the Prometheus text format on a local HTTP endpoint.
+Recording a value is a bisect and a couple of additions under a lock, so it is cheap enough for the hot paths.
+"""
+
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+# Default latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Timer:
+    """
+    Context manager observing the elapsed wall time into a histogram
+    """
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(perf_counter() - self.start, *self.labels)
+        return False
+
+
+class Metric:
+    """
+    Base class for labeled metrics
+    """
+    type = None
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def _label_str(self, label_values, extra=None):
+        pairs = list(zip(self.labels, label_values))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs) + "}"
+
+    def render(self) -> List[str]:
+        return ["# HELP {} {}".format(self.name, self.doc),
+                "# TYPE {} {}".format(self.name, self.type)]
+
+
+class Counter(Metric):
+    """
+    Monotonically increasing counter
+    """
+    type = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, doc, labels)
+        self.values: Dict[Tuple, float] = {}
+
+    def inc(self, *label_values, amount=1):
+        """
+        Increments the counter
+        :param label_values: Label values in the order of the label names
+        :param amount: Increment
+        :return: None
+        """
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self.lock:
+            values = dict(self.values)
+        for label_values, value in values.items():
+            lines.append("{}{} {}".format(self.name, self._label_str(label_values), value))
+        return lines
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down
+    """
+    type = "gauge"
+
+    def set(self, value: float, *label_values):
+        """
+        Sets the gauge value
+        :param value: New value
+        :param label_values: Label values in the order of the label names
+        :return: None
+        """
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    """
+    Cumulative histogram with fixed buckets
+    """
+    type = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts..., +Inf count, sum]
+        self.values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, *label_values):
+        """
+        Records one observation
+        :param value: Observed value
+        :param label_values: Label values in the order of the label names
+        :return: None
+        """
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                counts = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[idx] += 1
+            counts[-1] += value
+
+    def add(self, counts: List[int], total: float, *label_values):
+        """
+        Records observations bucketed elsewhere, e.g. in another process
+        :param counts: Observation count of each bucket and +Inf, not cumulative
+        :param total: Sum of the observed values
+        :param label_values: Label values in the order of the label names
+        :return: None
+        """
+        with self.lock:
+            values = self.values.get(label_values)
+            if values is None:
+                values = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            for i, count in enumerate(counts):
+                values[i] += count
+            values[-1] += total
+
+    def time(self, *label_values) -> _Timer:
+        """
+        Times a block of code
+        :param label_values: Label values in the order of the label names
+        :return: Context manager
+        """
+        return _Timer(self, label_values)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self.lock:
+            values = {k: list(v) for k, v in self.values.items()}
+        for label_values, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append("{}_bucket{} {}".format(self.name,
+                                                     self._label_str(label_values, ("le", bound)),
+                                                     cumulative))
+            lines.append("{}_sum{} {}".format(self.name, self._label_str(label_values), counts[-1]))
+            lines.append("{}_count{} {}".format(self.name, self._label_str(label_values), cumulative))
+        return lines
+
+
+class Registry:
+    """
+    Collection of all metrics of the process
+    """
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def render(self) -> str:
+        """
+        Renders all metrics in the Prometheus text exposition format
+        :return: Metrics text
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+"""
+Bot metrics
+"""
+poll_latency = Histogram("kapinabot_poll_seconds", "Telegram getUpdates round trip time")
+handler_latency = Histogram("kapinabot_handler_seconds", "Command handler run time", ("command",))
+telegram_send_latency = Histogram("kapinabot_telegram_send_seconds", "Telegram send request time", ("method",))
+telegram_send_status = Counter("kapinabot_telegram_send_total", "Telegram send requests by status code",
+                               ("method", "status"))
+untappd_refresh_duration = Histogram("kapinabot_untappd_refresh_seconds", "Duration of a beer list refresh",
+                                     ("list",), buckets=(1, 5, 10, 30, 60, 120, 300, 600))
+untappd_page_fetch = Histogram("kapinabot_untappd_page_fetch_seconds", "Untappd page fetch time", ("page",))
+untappd_page_parse = Histogram("kapinabot_untappd_page_parse_seconds", "Untappd page parse time, including queueing",
+                               ("parser",))
+proxy_attempts = Counter("kapinabot_proxy_attempts_total",
+                         "Proxy connection attempts by result: success, bad_status or failure", ("result",))
+camera_capture = Histogram("kapinabot_camera_capture_seconds", "Camera frame read time")
+camera_encode = Histogram("kapinabot_camera_encode_seconds", "Snapshot processing and encoding time", ("variant",))
+camera_jpeg_bytes = Histogram("kapinabot_camera_jpeg_bytes", "Snapshot size", ("variant",),
+                              buckets=(10e3, 20e3, 40e3, 80e3, 160e3, 320e3, 640e3, 1.28e6))
+label_cache = Counter("kapinabot_label_cache_total", "Label thumbnail lookups by result", ("result",))
+chart_cache = Counter("kapinabot_chart_cache_total", "Drink chart lookups by result", ("result",))
+chart_render = Histogram("kapinabot_chart_render_seconds", "Drink chart rendering time, including queueing")
+db_query = Histogram("kapinabot_db_query_seconds", "SQLite query time")
+startup_time = Gauge("kapinabot_startup_seconds", "Initialization time per subsystem", ("subsystem",))
+
+
+# Path -> function taking the query parameters and returning (content type, body)
+_routes: Dict[str, Callable[[Dict[str, str]], Tuple[str, bytes]]] = {}
+
+
+def register_route(path: str, handler: Callable[[Dict[str, str]], Tuple[str, bytes]]):
+    """
+    Serves another local endpoint next to /metrics
+    :param path: URL path
+    :param handler: Function taking the query parameters and returning the content type and body
+    :return: None
+    """
+    _routes[path] = handler
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the metrics registry at /metrics and the registered routes
+    """
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == "/metrics":
+            content_type, body = "text/plain; version=0.0.4; charset=utf-8", registry.render().encode("utf-8")
+        elif url.path in _routes:
+            content_type, body = _routes[url.path](dict(parse_qsl(url.query)))
+        else:
+            self.send_error(404)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent, keep them out of the journal
+        pass
+
+
+def start_http_server(port: int, address: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    Starts serving metrics on a background thread
+    :param port: TCP port
+    :param address: Bind address, local only by default
+    :return: Server instance
+    """
+    server = ThreadingHTTPServer((address, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
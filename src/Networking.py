@@ -3,6 +3,11 @@ import random
 import time
 from typing import Dict
 
+import Metrics
+import LogUtils
+
+log = LogUtils.get_logger("Networking")
+
 
 class NetworkHandler:
 
@@ -31,28 +36,33 @@ class NetworkHandler:
         """
         return requests.get(url, params=parameters, headers=headers, proxies=self.proxies)
 
-    def set_random_proxy(self):
+    def set_random_proxy(self) -> bool:
         """
         Sets or updates the instance to use a random proxy.
         Includes a simple spinlock for avoiding multiple access ->
         Multi-accessors will wait for the first requester to complete proxy update.
-        :return: None
+        :return: True if a working proxy is set
         """
 
         # Behold the worlds dumbest spinlock
         if self.proxy_update:
             while self.proxy_update:
                 time.sleep(1)
-            return
+            return self.proxies is not None
 
         self.proxy_update = True
         proxy_list_url = "https://raw.githubusercontent.com/clarketm/proxy-list/master/proxy-list-raw.txt"
         test_url = 'https://httpbin.org/ip'
-        data = requests.get(proxy_list_url).text.split("\n")
+        try:
+            data = requests.get(proxy_list_url, timeout=10).text.split("\n")
+        except Exception as e:
+            log.warning("Proxy list download failed", extra={"fields": {"error": e}})
+            self.proxy_update = False
+            return False
         random.shuffle(data)
 
         for ip in data:
-            print("Connecting to proxy at " + ip)
+            log.debug("Connecting to proxy", extra={"sample": "proxy_attempt", "fields": {"proxy": ip}})
             proxies = {
                 "http": "http://" + ip,
                 "https": "https://" + ip
@@ -61,15 +71,21 @@ class NetworkHandler:
             try:
                 response = requests.get(test_url, proxies=proxies, timeout=5).status_code
                 if response == 200:
-                    print("Proxy connection succeeded")
+                    Metrics.proxy_attempts.inc("success")
+                    log.info("Proxy connection succeeded", extra={"fields": {"proxy": ip}})
                     self.proxies = proxies
                     self.proxy_update = False
-                    return
+                    return True
+                Metrics.proxy_attempts.inc("bad_status")
+                log.debug("Proxy returned an error status",
+                          extra={"sample": "proxy_attempt", "fields": {"proxy": ip, "status": response}})
             except Exception:
-                print("Proxy connection failed")
+                Metrics.proxy_attempts.inc("failure")
+                log.debug("Proxy connection failed", extra={"sample": "proxy_attempt", "fields": {"proxy": ip}})
 
-        print("No working proxy found")
+        log.warning("No working proxy found")
         self.proxy_update = False
+        return False
 
 
 if __name__ == "__main__":
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+On-demand runtime diagnostics.
+
+A profile run samples the stacks of all threads from sys._current_frames() for a given time, reads the CPU time of
+each thread and child process from /proc, traces memory allocations with tracemalloc and collects the state of the
+registered thread pools and queues. Nothing runs and nothing is traced outside a profile run.
+
+Allocation tracing is started for the profile only, so the top allocation sites are those of the profiling time. Run
+the bot with PYTHONTRACEMALLOC=1 to trace from startup and see what holds the memory, at a constant cost.
+"""
+
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+
+import LogUtils
+
+log = LogUtils.get_logger("Profiler")
+
+SAMPLE_INTERVAL = 0.01
+# Allocation sites are reported by line, deeper tracebacks make every allocation slower while tracing
+TRACEMALLOC_FRAMES = 1
+TOP_STACKS = 15
+TOP_FUNCTIONS = 25
+TOP_ALLOCATIONS = 25
+
+# Name -> function returning a dict describing a pool, queue or subsystem
+_states: Dict[str, Callable[[], Dict]] = {}
+_lock = threading.Lock()
+
+
+def register_state(name: str, state: Callable[[], Dict]):
+    """
+    Registers a state to include in the profile reports
+    :param name: State name
+    :param state: Function returning a dict of values
+    :return: None
+    """
+    _states[name] = state
+
+
+def executor_state(executor) -> Dict:
+    """
+    Describes a ThreadPoolExecutor or ProcessPoolExecutor
+    :param executor: Executor, None if not started
+    :return: State dict
+    """
+    if executor is None:
+        return {"started": False}
+    state = {"max_workers": executor._max_workers}
+    if hasattr(executor, "_work_queue"):
+        state["threads"] = len(executor._threads)
+        state["queued"] = executor._work_queue.qsize()
+    else:
+        state["processes"] = [p.pid for p in (executor._processes or {}).values()]
+        state["pending"] = len(executor._pending_work_items)
+    return state
+
+
+def _cpu_seconds(stat_path: str) -> float:
+    try:
+        with open(stat_path) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return 0.0
+
+
+def _child_pids() -> List[int]:
+    pids = []
+    try:
+        for task in os.listdir("/proc/self/task"):
+            with open("/proc/self/task/{}/children".format(task)) as f:
+                pids.extend(int(pid) for pid in f.read().split())
+    except OSError:
+        pass
+    return pids
+
+
+def _cpu_times() -> Dict[str, float]:
+    """
+    :return: CPU seconds of each thread and child process, keyed by description
+    """
+    times = {}
+    for thread in threading.enumerate():
+        if thread.native_id is not None:
+            times["thread " + thread.name] = _cpu_seconds("/proc/self/task/{}/stat".format(thread.native_id))
+    for pid in _child_pids():
+        times["process {}".format(pid)] = _cpu_seconds("/proc/{}/stat".format(pid))
+    return times
+
+
+def _snapshot() -> tracemalloc.Snapshot:
+    """
+    :return: Traced allocations, excluding the profiler's own
+    """
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, __file__),
+                                                      tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def sample(seconds: float, interval=SAMPLE_INTERVAL) -> Tuple[Dict[Tuple[str, Tuple[str, ...]], int], int]:
+    """
+    Samples the stacks of all other threads
+    :param seconds: Sampling time
+    :param interval: Seconds between samples
+    :return: (thread name, stack from the outermost frame) -> sample count, number of sampling rounds
+    """
+    me = threading.get_ident()
+    stacks = Counter()
+    # (code, line) -> frame name, formatting every frame of every sample would cost more than the walk itself
+    frame_names = {}
+    rounds = 0
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                key = (frame.f_code, frame.f_lineno)
+                name = frame_names.get(key)
+                if name is None:
+                    name = frame_names[key] = "{} ({}:{})".format(
+                        key[0].co_name, os.path.basename(key[0].co_filename), key[1])
+                stack.append(name)
+                frame = frame.f_back
+            stack.reverse()
+            stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+        rounds += 1
+        time.sleep(interval)
+    return stacks, rounds
+
+
+def profile(seconds: float) -> str:
+    """
+    Runs a profile and formats the report. Only one profile runs at a time.
+    :param seconds: Profiling time
+    :return: Report text, or a note that a profile is already running
+    """
+    if not _lock.acquire(blocking=False):
+        return "A profile is already running\n"
+    try:
+        log.info("Profiling", extra={"fields": {"seconds": seconds}})
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        memory_start = _snapshot()
+        cpu_start = _cpu_times()
+        wall_start = time.perf_counter()
+
+        stacks, rounds = sample(seconds)
+
+        wall = time.perf_counter() - wall_start
+        cpu_end = _cpu_times()
+        memory_end = _snapshot()
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+
+        lines = ["Profile of pid {} at {}, {:.1f} s, {} samples per thread every {:.0f} ms".format(
+            os.getpid(), time.strftime("%Y-%m-%d %H:%M:%S"), wall, rounds, SAMPLE_INTERVAL * 1000), ""]
+
+        lines.append("== CPU time during the profile")
+        cpu = sorted(((cpu_end[name] - cpu_start.get(name, 0), name) for name in cpu_end), reverse=True)
+        for seconds_used, name in cpu:
+            lines.append("{:>8.2f} s {:>6.1f} %  {}".format(seconds_used, 100 * seconds_used / wall, name))
+        lines.append("")
+
+        lines.append("== States")
+        for name, state in sorted(_states.items()):
+            try:
+                lines.append("{}: {}".format(name, state()))
+            except Exception as e:
+                lines.append("{}: failed: {}".format(name, e))
+        lines.append("")
+
+        lines.append("== Functions by samples (self / total), all threads")
+        own = Counter()
+        total = Counter()
+        for (_, stack), count in stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack):
+                total[frame] += count
+        for frame, count in own.most_common(TOP_FUNCTIONS):
+            lines.append("{:>7} {:>7}  {}".format(count, total[frame], frame))
+        lines.append("")
+
+        lines.append("== Top stacks per thread (samples, innermost frame first)")
+        threads = Counter()
+        for (thread, _), count in stacks.items():
+            threads[thread] += count
+        for thread in sorted(threads):
+            lines.append("-- " + thread)
+            top = sorted(((count, stack) for (name, stack), count in stacks.items() if name == thread),
+                         reverse=True)[:TOP_STACKS]
+            for count, stack in top:
+                lines.append("{:>7}  {}".format(count, " <- ".join(reversed(stack[-4:]))))
+        lines.append("")
+
+        lines.append("== Memory: traced {:.1f} MiB, peak {:.1f} MiB during the profile".format(
+            traced / 2 ** 20, traced_peak / 2 ** 20))
+        lines.append("-- Top allocation sites")
+        for stat in memory_end.statistics("lineno")[:TOP_ALLOCATIONS]:
+            lines.append(str(stat))
+        lines.append("-- Growth during the profile")
+        for stat in memory_end.compare_to(memory_start, "lineno")[:TOP_ALLOCATIONS]:
+            lines.append(str(stat))
+        lines.append("")
+
+        lines.append("== Collapsed stacks (thread;outermost;...;innermost samples), for flame graph tools")
+        for (thread, stack), count in sorted(stacks.items()):
+            lines.append("{};{} {}".format(thread, ";".join(stack), count))
+
+        return "\n".join(lines) + "\n"
+    finally:
+        _lock.release()
+
+
+def parse_seconds(value, default: float, maximum: float) -> float:
+    """
+    :param value: Requested profiling time, None for the default
+    :param default: Default profiling time
+    :param maximum: Upper limit of the profiling time
+    :return: Profiling time in seconds
+    """
+    try:
+        seconds = float(value) if value is not None else default
+    except ValueError:
+        seconds = default
+    return min(max(seconds, 0.1), maximum)
+
+
+def handle_profile_request(parameters: Dict[str, str], default_seconds: float = 10,
+                           max_seconds: float = 60) -> Tuple[str, bytes]:
+    """
+    Local HTTP endpoint, e.g. /debug/profile?seconds=10
+    :param parameters: Query parameters
+    :param default_seconds: Profiling time if not given
+    :param max_seconds: Upper limit of the profiling time
+    :return: Content type, body
+    """
+    seconds = parse_seconds(parameters.get("seconds"), default_seconds, max_seconds)
+    return "text/plain; charset=utf-8", profile(seconds).encode("utf-8")
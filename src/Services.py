@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Lazily initialized subsystems.
+
+Heavy subsystems (camera, Untappd crawler, database) are registered with a factory and created on first use or
+by a background warm-up, so the bot can start polling Telegram right away after a restart.
+"""
+
+import threading
+from time import perf_counter
+from typing import Callable, Dict, Iterable
+
+import Metrics
+import LogUtils
+
+log = LogUtils.get_logger("Services")
+
+
+class LazyService:
+    """
+    Holds one subsystem instance, created by its factory at most once
+    """
+
+    def __init__(self, name: str, factory: Callable):
+        self.name = name
+        self.factory = factory
+        self.instance = None
+        self.init_time = None
+        # Error of the latest failed initialization, cleared when one succeeds
+        self.error = None
+        self.lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.init_time is not None
+
+    def get(self):
+        """
+        Returns the instance, initializing it if needed. Concurrent callers wait for the first initialization.
+        :return: Service instance
+        """
+        if self.init_time is not None:
+            return self.instance
+
+        with self.lock:
+            if self.init_time is None:
+                start = perf_counter()
+                try:
+                    self.instance = self.factory()
+                except Exception as e:
+                    self.error = e
+                    raise
+                self.init_time = perf_counter() - start
+                self.error = None
+                Metrics.startup_time.set(self.init_time, self.name)
+                log.info("Subsystem initialized", extra={"fields": {"subsystem": self.name,
+                                                                    "seconds": "{:.3f}".format(self.init_time)}})
+        return self.instance
+
+
+class ServiceContainer:
+    """
+    Registry of lazy services, accessible as attributes
+    """
+
+    def __init__(self):
+        self._services: Dict[str, LazyService] = {}
+
+    def register(self, name: str, factory: Callable):
+        """
+        Registers a service factory
+        :param name: Service name
+        :param factory: Callable constructing the service
+        :return: None
+        """
+        self._services[name] = LazyService(name, factory)
+
+    def __getattr__(self, name):
+        try:
+            return self._services[name].get()
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, name: str):
+        """
+        :param name: Service name
+        :return: Service instance
+        """
+        return self._services[name].get()
+
+    def ready(self, name: str) -> bool:
+        return self._services[name].ready
+
+    def failed(self, name: str) -> bool:
+        """
+        :param name: Service name
+        :return: True if the latest initialization attempt raised
+        """
+        service = self._services[name]
+        return not service.ready and service.error is not None
+
+    def warm_up(self, names: Iterable[str] = None):
+        """
+        Initializes services on background threads
+        :param names: Service names, defaults to all services
+        :return: None
+        """
+        for name in names if names is not None else list(self._services):
+            threading.Thread(target=self._warm_up, args=(name,), name="warmup-" + name, daemon=True).start()
+
+    def _warm_up(self, name: str):
+        try:
+            self._services[name].get()
+        except Exception:
+            log.exception("Subsystem initialization failed", extra={"fields": {"subsystem": name}})
+
+    def startup_report(self) -> Dict[str, float]:
+        """
+        :return: Initialization times in seconds of the initialized services
+        """
+        return {name: service.init_time for name, service in self._services.items() if service.ready}
@@ -1,10 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from typing import List, Dict
+import json
+from time import perf_counter
+from typing import List, Dict, Optional, Tuple, Union
 import requests
 
 from Networking import NetworkHandler
+import Metrics
+import LogUtils
+
+log = LogUtils.get_logger("TelegramUtils")
 
 
 class Message:
@@ -47,7 +53,7 @@ class Message:
             if "text" in json: self.text = json["text"]
             if "username" in json["from"]: self.username = json["from"]["username"]
         except KeyError as ke:
-            print("Message construction failed:" + str(ke))
+            log.warning("Message construction failed", extra={"fields": {"missing": ke}})
 
     def __str__(self):
         return "Chat:" + str(self.chat_id) + " Sender: " + str(self.user_id) + " Text: " + self.text
@@ -59,11 +65,40 @@ class Message:
             return False
 
 
+class InlineQuery:
+    """
+    Represents an incoming inline query
+    """
+
+    def __init__(self):
+        self.query_id = None
+        self.user_id = None
+        self.username = None
+        self.query = ""
+
+    def load_from_json(self, json):
+        """
+        Load object from JSON data
+        :param json: JSON inline query data from telegram API
+        :return: None
+        """
+        try:
+            self.query_id = json["id"]
+            self.user_id = json["from"]["id"]
+            self.query = json.get("query", "")
+            if "username" in json["from"]: self.username = json["from"]["username"]
+        except KeyError as ke:
+            log.warning("Inline query construction failed", extra={"fields": {"missing": ke}})
+
+    def __str__(self):
+        return "Inline query: " + str(self.query_id) + " Sender: " + str(self.user_id) + " Query: " + self.query
+
+
 class TelegramHttpsAPI:
     """
     Python abstraction for telegram HTTPS API.
-    Currently only handling incoming messages with text content, incoming files not handled.
-    Capable of sending text and image media.
+    Currently only handling incoming messages with text content and inline queries, incoming files not handled.
+    Capable of sending text, image media and files and answering inline queries.
     """
 
     BASE_URL = "https://api.telegram.org/bot"
@@ -72,14 +107,22 @@ class TelegramHttpsAPI:
     GETUPDATES = "/getUpdates"
     SENDMESSAGE = "/sendMessage"
     SENDPHOTO = "/sendPhoto"
+    SENDMEDIAGROUP = "/sendMediaGroup"
+    SENDDOCUMENT = "/sendDocument"
+    ANSWERINLINEQUERY = "/answerInlineQuery"
+
+    # Photos per media group
+    MEDIA_GROUP_MIN = 2
+    MEDIA_GROUP_MAX = 10
 
-    def __init__(self, token):
+    def __init__(self, token, base_url=BASE_URL):
         """
         Initialize the API to given bot token
         :param token: bot token
+        :param base_url: API base URL, the token is appended to this
         """
         self.token = token
-        self.url = TelegramHttpsAPI.BASE_URL + self.token
+        self.url = base_url + self.token
         self.update_id = None
         self.net = NetworkHandler()
 
@@ -89,16 +132,17 @@ class TelegramHttpsAPI:
         :return: JSON update data as a dict
         """
         request_url = self.url + TelegramHttpsAPI.GETUPDATES
-        data = self.net.https_get(request_url, {"offset": self.update_id})
+        with Metrics.poll_latency.time():
+            data = self.net.https_get(request_url, {"offset": self.update_id})
         try:
             return data.json()["result"]
         except ValueError:
             return None
 
-    def get_messages(self) -> List[Message]:
+    def get_messages(self) -> List[Union[Message, InlineQuery]]:
         """
-        Get unhandled message updates
-        :return: List of unhandled message objects
+        Get unhandled message and inline query updates
+        :return: List of unhandled message and inline query objects
         """
         messages = []
         updates = self.get_updates()
@@ -106,21 +150,26 @@ class TelegramHttpsAPI:
         # Iterate through the updates
         for update in updates:
             self.update_id = update["update_id"] + 1
-            raw_message = update["message"]
+            raw_message = update.get("message")
+            raw_query = update.get("inline_query")
             if raw_message:
                 # We are only interested in updates with text content
                 if "text" in raw_message:
                     message_obj = Message()
                     message_obj.load_from_json(raw_message)
                     messages.append(message_obj)
+            elif raw_query:
+                query_obj = InlineQuery()
+                query_obj.load_from_json(raw_query)
+                messages.append(query_obj)
 
         return messages
 
     def send_message(self, message: Message):
         """
         Sends given message. Message type (photo, text, etc.) depends on the contents of the message object
-        :param message: Message object. Optional photo attribute must be a path to a local file.
-        :return: None
+        :param message: Message object. Optional photo attribute is either JPEG bytes or a path to a local file.
+        :return: The sent message as returned by the API, None if sending failed
         """
 
         if message.photo:
@@ -128,9 +177,13 @@ class TelegramHttpsAPI:
             parameters = {"chat_id": message.chat_id,
                           "caption": message.text,
                           "reply_to_message_id": message.reply_to}
-            files = {"photo": open(message.photo, "rb")}
-
-            self.net.https_post(post_url, parameters, files)
+            if isinstance(message.photo, (bytes, bytearray)):
+                name = "photo.png" if message.photo.startswith(b"\x89PNG") else "photo.jpg"
+                return self.__result(self.__post("sendPhoto", post_url, parameters,
+                                                 {"photo": (name, message.photo)}))
+            else:
+                with open(message.photo, "rb") as photo:
+                    return self.__result(self.__post("sendPhoto", post_url, parameters, {"photo": photo}))
 
         elif message.text:
             post_url = self.url + TelegramHttpsAPI.SENDMESSAGE
@@ -140,7 +193,121 @@ class TelegramHttpsAPI:
                           "parse_mode": message.parse_mode,
                           "disable_web_page_preview": message.disable_web_page_preview}
 
-            self.net.https_post(post_url, parameters)
+            return self.__result(self.__post("sendMessage", post_url, parameters))
+
+        else:
+            log.warning("No message content available")
+            return None
+
+    def send_document(self, chat_id, filename: str, data: bytes, reply_to=None, caption=None):
+        """
+        Sends a file
+        :param chat_id: Chat to send to
+        :param filename: File name shown in the chat
+        :param data: File content
+        :param reply_to: Message id to reply to
+        :param caption: Optional caption
+        :return: The sent message as returned by the API, None if sending failed
+        """
+        parameters = {"chat_id": chat_id,
+                      "caption": caption,
+                      "reply_to_message_id": reply_to}
+        return self.__result(self.__post("sendDocument", self.url + TelegramHttpsAPI.SENDDOCUMENT, parameters,
+                                         {"document": (filename, data)}))
+
+    def answer_inline_query(self, query_id, results: str, cache_time=300):
+        """
+        Answers an inline query
+        :param query_id: Inline query id
+        :param results: Results as a serialized JSON array of InlineQueryResult objects
+        :param cache_time: Seconds the answer may be cached by Telegram
+        :return: True if succeeded
+        """
+        parameters = {"inline_query_id": query_id,
+                      "results": results,
+                      "cache_time": cache_time}
+        return self.__result(self.__post("answerInlineQuery", self.url + TelegramHttpsAPI.ANSWERINLINEQUERY,
+                                         parameters)) is not None
+
+    def send_media_group(self,
+                         chat_id,
+                         media: List[Tuple[Union[bytes, str], str]],
+                         reply_to=None,
+                         parse_mode=None) -> List[Optional[str]]:
+        """
+        Sends photos as an album. A single photo is sent as a plain photo message.
+        :param chat_id: Chat to send to
+        :param media: List of (photo, caption), photo is either JPEG bytes or the file id of an earlier upload.
+                      At most MEDIA_GROUP_MAX photos.
+        :param reply_to: Message id to reply to
+        :param parse_mode: Caption parse mode
+        :return: File ids of the sent photos in the order given, None where unknown
+        """
+        files = {}
+        items = []
+        for i, (photo, caption) in enumerate(media):
+            if isinstance(photo, (bytes, bytearray)):
+                files["photo{}".format(i)] = ("photo{}.jpg".format(i), photo)
+                photo = "attach://photo{}".format(i)
+            item = {"type": "photo", "media": photo, "caption": caption}
+            if parse_mode is not None:
+                item["parse_mode"] = parse_mode
+            items.append(item)
 
+        if len(items) < TelegramHttpsAPI.MEDIA_GROUP_MIN:
+            parameters = {"chat_id": chat_id,
+                          "caption": items[0]["caption"],
+                          "parse_mode": parse_mode,
+                          "reply_to_message_id": reply_to}
+            if files:
+                response = self.__post("sendPhoto", self.url + TelegramHttpsAPI.SENDPHOTO, parameters,
+                                       {"photo": files["photo0"]})
+            else:
+                parameters["photo"] = items[0]["media"]
+                response = self.__post("sendPhoto", self.url + TelegramHttpsAPI.SENDPHOTO, parameters)
+            results = [self.__result(response)]
         else:
-            print("No message content available")
+            parameters = {"chat_id": chat_id,
+                          "media": json.dumps(items),
+                          "reply_to_message_id": reply_to}
+            results = self.__result(self.__post("sendMediaGroup", self.url + TelegramHttpsAPI.SENDMEDIAGROUP,
+                                                parameters, files or None))
+
+        if not isinstance(results, list) or len(results) != len(media):
+            return [None] * len(media)
+        return [result["photo"][-1]["file_id"] if result and result.get("photo") else None for result in results]
+
+    @staticmethod
+    def __result(response):
+        """
+        :param response: Bot API response
+        :return: Result of a successful request, None otherwise
+        """
+        try:
+            data = response.json()
+        except ValueError:
+            return None
+        if not data.get("ok"):
+            log.warning("Request failed", extra={"fields": {"error": data.get("description")}})
+            return None
+        return data["result"]
+
+    def __post(self, method, url, parameters, files=None):
+        """
+        Posts a request to the bot API and records its latency and status
+        :param method: API method name for metrics
+        :param url: POST URL
+        :param parameters: Parameters
+        :param files: Multipart file data to send
+        :return: Response
+        """
+        start = perf_counter()
+        try:
+            response = self.net.https_post(url, parameters, files)
+        except Exception:
+            Metrics.telegram_send_status.inc(method, "error")
+            raise
+        finally:
+            Metrics.telegram_send_latency.observe(perf_counter() - start, method)
+        Metrics.telegram_send_status.inc(method, str(response.status_code))
+        return response
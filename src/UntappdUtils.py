@@ -7,23 +7,35 @@ README
 Untappd uses many methods to block web scraping. Due to these measures, this class program utilizes a pool of
 random proxies to avoid being IP blocked from the site. This considerably slows down the update process, so updates are run
 periodically in the background.
+
+Pages are fetched on a thread pool and parsed in a process pool: parsing is CPU bound and would otherwise hold the GIL
+away from the bot's own threads. Only the raw page bytes and the extracted beer records cross the process boundary.
 """
 
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from threading import Semaphore, Thread
-from time import sleep
-from typing import Dict, List
-from bs4 import BeautifulSoup
+from datetime import datetime
+from threading import Condition, Lock, Semaphore, Thread
+from time import time
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urljoin
 import requests
 
 from Networking import NetworkHandler
+from LabelCache import LabelCache
+from BeerIndex import BeerIndex, parse_query
+from WorkerPool import WorkerPool
+import Metrics
+import LogUtils
+
+log = LogUtils.get_logger("UntappdUtils")
 
 # We'll have to fake being a real user, otherwise Untappd blocks the requests
 common_header = {
     'User-Agent': 'Mozilla/5.0'
 }
 
-tpe = ThreadPoolExecutor(max_workers=10)
+tpe = ThreadPoolExecutor(max_workers=10, thread_name_prefix="untappd-fetch")
 
 
 class Beer:
@@ -57,14 +69,110 @@ class Beer:
         return "[{}]({}) ({}) - {}, {}\n*{:.2f}/5*".format(self.name, self.url, self.style, self.brewery, self.abv, self.rating)
 
 
+def parse_menu(html: bytes, list_url: str) -> List[str]:
+    """
+    Extracts the beer page URLs from a menu page
+    :param html: Menu page
+    :param list_url: Menu URL, links are relative to it
+    :return: Beer page URLs
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, features="html5lib")
+    raw_beer_list = soup.find("ul", {"class": "menu-section-list"})
+    return [urljoin(list_url, beer.find("a", href=True)["href"]) for beer in raw_beer_list.find_all("li")]
+
+
+def parse_beer(html: bytes, url: str) -> Dict:
+    """
+    Extracts the beer record from a beer page
+    :param html: Beer page
+    :param url: Beer page URL, the label link is relative to it
+    :return: Beer keyword arguments
+    """
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, features="html5lib")
+
+    basic_info = soup.find("div", {"class": "name"})
+    name = basic_info.find("h1").text
+    brewery = basic_info.find("p", {"class": "brewery"}).find("a").text
+    style = basic_info.find("p", {"class": "style"}).text
+    img = urljoin(url, soup.find("a", {"class": "label"}).find("img")["src"])
+
+    details = soup.find("div", {"class": "details"})
+    abv = details.find("p", {"class": "abv"}).text.strip()
+    rating = details.find("div", {"class": "caps"})["data-rating"]
+    ratings = details.find("p", {"class": "raters"}).text
+
+    return {"name": name,
+            "brewery": brewery,
+            "rating": float(rating),
+            "ratings": ratings,
+            "abv": abv,
+            "style": style,
+            "img": img}
+
+
 class UntappdCrawler:
-    BASE_URL = "https://untappd.com"
+    # Seconds to wait before looking for a proxy again after a failed search, doubled after each failure
+    PROXY_RETRY_MIN = 60
+    PROXY_RETRY_MAX = 60 * 60
 
-    def __init__(self):
+    def __init__(self, use_proxy=True, parse_workers=2):
+        """
+        Initializes the crawler
+        :param use_proxy: Crawl through a random proxy
+        :param parse_workers: Page parsing processes, 0 to parse on the fetching threads
+        """
         self.beer_lists = {}
         self.default_beer_list = None
+        self.use_proxy = use_proxy
         self.net = NetworkHandler()
-        self.net.set_random_proxy()
+        self.parse_workers = parse_workers
+        self.parse_pool = WorkerPool("untappd-parse", parse_workers)
+        self.proxy_retry_at = 0.0
+        self.proxy_retry_delay = UntappdCrawler.PROXY_RETRY_MIN
+
+    def parse(self, parser: Callable, html: bytes, url: str):
+        """
+        Parses a page in the parsing process pool, started on first use
+        :param parser: Module level parse function
+        :param html: Page
+        :param url: Page URL
+        :return: Parser result
+        """
+        with Metrics.untappd_page_parse.time(parser.__name__):
+            if not self.parse_workers:
+                return parser(html, url)
+            return self.parse_pool.run(parser, html, url)
+
+    def shutdown(self):
+        """
+        Stops the parsing processes
+        :return: None
+        """
+        self.parse_pool.shutdown()
+
+    def ensure_proxy(self):
+        """
+        Picks a proxy on first use, probing proxies is slow so it is not done on construction.
+        If no proxy is found, pages are fetched directly and the search is retried with an increasing delay.
+        :return: None
+        """
+        if not self.use_proxy or self.net.proxies is not None or time() < self.proxy_retry_at:
+            return
+        try:
+            found = self.net.set_random_proxy()
+        except Exception:
+            log.exception("Proxy search failed")
+            found = False
+        if found:
+            self.proxy_retry_delay = UntappdCrawler.PROXY_RETRY_MIN
+        else:
+            log.warning("Crawling without a proxy", extra={"fields": {"retry_s": self.proxy_retry_delay}})
+            self.proxy_retry_at = time() + self.proxy_retry_delay
+            self.proxy_retry_delay = min(2 * self.proxy_retry_delay, UntappdCrawler.PROXY_RETRY_MAX)
 
     def set_beer_lists(self, lists: Dict):
         """
@@ -99,13 +207,12 @@ class UntappdCrawler:
 
         beers = []
         beer_futures = []
+
         try:
-            data = self.net.https_get(self.beer_lists[list], headers=common_header).text
-            soup = BeautifulSoup(data, features="html5lib")
-            raw_beer_list = soup.find("ul", {"class": "menu-section-list"})
-            for beer in raw_beer_list.find_all("li"):
-                beer_futures.append(
-                    tpe.submit(self.get_beer, UntappdCrawler.BASE_URL + beer.find("a", href=True)["href"]))
+            with Metrics.untappd_page_fetch.time("menu"):
+                data = self.net.https_get(self.beer_lists[list], headers=common_header).content
+            for url in self.parse(parse_menu, data, self.beer_lists[list]):
+                beer_futures.append(tpe.submit(self.get_beer, url))
 
             for i, future in enumerate(beer_futures):
                 result = future.result()
@@ -115,16 +222,16 @@ class UntappdCrawler:
             return beers
 
         except requests.exceptions.ConnectTimeout:
-            print("Connection timed out when getting menu! Trying again")
+            log.warning("Connection timed out when getting menu! Trying again")
             return self.get_beers_on_list(list, tries - 1)
         
         except requests.exceptions.ProxyError:
-            print("Proxy connection error when getting menu! Retrying")
+            log.warning("Proxy connection error when getting menu! Retrying")
             self.net.set_random_proxy()
             return self.get_beers_on_list(list, tries - 1)
 
         except Exception as e:
-            print(str(e) + "while getting venue data! Retrying")
+            log.warning("Error while getting venue data! Retrying", extra={"fields": {"error": e}})
             return self.get_beers_on_list(list, tries - 1)
 
     def get_beer(self, url: str, tries=3):
@@ -139,56 +246,246 @@ class UntappdCrawler:
             return None
 
         try:
-            data = self.net.https_get(url, headers=common_header).text
-            soup = BeautifulSoup(data, features="html5lib")
-
-            basic_info = soup.find("div", {"class": "name"})
-            name = basic_info.find("h1").text
-            brewery = basic_info.find("p", {"class": "brewery"}).find("a").text
-            style = basic_info.find("p", {"class": "style"}).text
-            img = soup.find("a", {"class": "label"}).find("img")["src"]
-
-            details = soup.find("div", {"class": "details"})
-            abv = details.find("p", {"class": "abv"}).text.strip()
-            rating = details.find("div", {"class": "caps"})["data-rating"]
-            ratings = details.find("p", {"class": "raters"}).text
-
-            return Beer(name=name,
-                        brewery=brewery,
-                        rating=float(rating),
-                        ratings=ratings,
-                        abv=abv,
-                        style=style,
-                        img=img,
-                        url=url)
+            with Metrics.untappd_page_fetch.time("beer"):
+                data = self.net.https_get(url, headers=common_header).content
+            return Beer(url=url, **self.parse(parse_beer, data, url))
 
         except requests.exceptions.ConnectTimeout:
-            print("Connection timed out when getting beer data! Trying again")
+            log.warning("Connection timed out when getting beer data! Trying again")
             return self.get_beer(url, tries - 1)
 
         except requests.exceptions.ProxyError:
-            print("Proxy connection error when getting beer data! Finding another one")
+            log.warning("Proxy connection error when getting beer data! Finding another one")
             self.net.set_random_proxy()
             return self.get_beer(url, tries - 1)
 
         except Exception as e:
-            print("Error getting beer data" + e)
+            log.warning("Error getting beer data", extra={"fields": {"url": url, "error": e}})
+            return None
+
+    def get_label(self, url: str) -> Optional[bytes]:
+        """
+        Downloads a beer label image
+        :param url: Label image URL
+        :return: Image data, None if failed
+        """
+        try:
+            with Metrics.untappd_page_fetch.time("label"):
+                response = self.net.https_get(url, headers=common_header)
+            if response.status_code != 200:
+                log.warning("Label download failed", extra={"fields": {"url": url, "status": response.status_code}})
+                return None
+            return response.content
+
+        except requests.exceptions.ProxyError:
+            log.warning("Proxy connection error when getting label! Finding another one")
+            self.net.set_random_proxy()
+            return None
+
+        except Exception as e:
+            log.warning("Error getting label", extra={"fields": {"url": url, "error": e}})
+            return None
+
+
+class OpeningHours:
+    """
+    Weekly opening hours of a venue. Closing times past midnight belong to the previous day's opening.
+    """
+    DAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+
+    def __init__(self, hours: Dict[str, Tuple[str, str]]):
+        """
+        :param hours: Dict["mon".."sun": ("HH:MM", "HH:MM")], days not listed are closed
+        """
+        self.periods = []
+        for day, (opens, closes) in hours.items():
+            start = OpeningHours.DAYS.index(day) * 1440 + self.__minutes(opens)
+            end = OpeningHours.DAYS.index(day) * 1440 + self.__minutes(closes)
+            if end <= start:
+                end += 1440
+            self.periods.append((start, end))
+
+    @staticmethod
+    def __minutes(hhmm: str) -> int:
+        h, m = hhmm.split(":")
+        return int(h) * 60 + int(m)
+
+    @staticmethod
+    def __week_minute(t: datetime) -> int:
+        return t.weekday() * 1440 + t.hour * 60 + t.minute
+
+    def is_open(self, t: datetime) -> bool:
+        minute = self.__week_minute(t)
+        # Periods of Sunday may extend into next week's Monday
+        return any(start <= m < end for start, end in self.periods for m in (minute, minute + 7 * 1440))
+
+    def seconds_until_open(self, t: datetime) -> float:
+        """
+        :param t: Current time
+        :return: Seconds until the next opening, 0 if open, None if never open
+        """
+        if self.is_open(t):
+            return 0
+        if not self.periods:
             return None
+        minute = self.__week_minute(t)
+        wait = min((start - minute) % (7 * 1440) for start, _ in self.periods)
+        return wait * 60 - t.second
+
+
+class CrawlScheduler:
+    """
+    Refreshes beer lists one at a time on a single thread.
+    The delay until the next refresh of each list is asked from a callback after every refresh, and refreshes can be
+    requested on demand. Requests for a list that is already being refreshed or queued are merged. A failing refresh
+    is logged and the list is rescheduled, the scheduler keeps running.
+    """
+
+    # Delay until the next refresh when the delay callback fails
+    FALLBACK_DELAY = 5 * 60
+
+    def __init__(self, delay: Callable[[str], float], refresh: Callable[[str], bool]):
+        """
+        :param delay: Function returning the delay in seconds until the next refresh of a list
+        :param refresh: Function refreshing one list
+        """
+        self.delay = delay
+        self.refresh = refresh
+        self.due: Dict[str, float] = {}
+        self.refreshing = None
+        self.stopped = False
+        self.cond = Condition()
+
+    def run(self, lists: List[str]):
+        """
+        Crawls all lists once, then keeps refreshing them until stopped.
+        After the first pass the refreshes are staggered over the delay so lists are not crawled back-to-back.
+        :param lists: List names
+        :return: None
+        """
+        self.stopped = False
+        if not lists:
+            return
+        for list in lists:
+            if self.stopped:
+                return
+            self.__refresh(list)
+
+        start = time()
+        delays = [self.__delay(list) for list in lists]
+        with self.cond:
+            for i, list in enumerate(lists):
+                # Lists requested during the first pass stay due right away
+                if self.due[list] > start:
+                    self.due[list] = start + delays[i] * (1 + i / len(lists))
+
+        while True:
+            with self.cond:
+                while True:
+                    if self.stopped:
+                        return
+                    list = min(self.due, key=self.due.get)
+                    wait = self.due[list] - time()
+                    if wait <= 0:
+                        break
+                    self.cond.wait(wait)
+            self.__refresh(list)
+
+    def __refresh(self, list):
+        with self.cond:
+            self.refreshing = list
+            self.due[list] = float("inf")
+        try:
+            self.refresh(list)
+        except Exception:
+            log.exception("Beer list refresh failed", extra={"fields": {"list": list}})
+        delay = self.__delay(list)
+        with self.cond:
+            self.refreshing = None
+            self.due[list] = min(self.due[list], time() + delay)
+
+    def __delay(self, list) -> float:
+        try:
+            return self.delay(list)
+        except Exception:
+            log.exception("Refresh delay failed", extra={"fields": {"list": list}})
+            return CrawlScheduler.FALLBACK_DELAY
+
+    def request(self, list: str):
+        """
+        Requests a refresh of a list as soon as possible
+        :param list: List name
+        :return: None
+        """
+        with self.cond:
+            if list == self.refreshing or list not in self.due or self.due[list] <= time():
+                return
+            self.due[list] = time()
+            self.cond.notify()
+
+    def reschedule(self, list: str):
+        """
+        Recomputes the next refresh time of a list, e.g. after its demand has changed
+        :param list: List name
+        :return: None
+        """
+        delay = self.__delay(list)
+        with self.cond:
+            if list == self.refreshing or list not in self.due:
+                return
+            self.due[list] = min(self.due[list], time() + delay)
+            self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
 
 
 class Untappd:
+    """
+    Beer model of the configured lists, kept up to date in the background.
+
+    Lists are refreshed more often when people ask for them and less often when nobody does. Outside the opening
+    hours of a venue its lists are not refreshed on schedule at all, except right before opening. Requests for stale
+    data are answered from the cached model right away and trigger a single background refresh.
+    """
+
+    # Requests per hour at which a list is refreshed at the base interval
+    BASE_DEMAND = 8
+    # Bounds of the refresh interval as multiples of the base interval
+    MIN_FACTOR = 0.5
+    MAX_FACTOR = 3
+    # Refresh this many seconds before a venue opens
+    OPENING_LEAD = 10 * 60
+
     def __init__(self,
-                 poll_interval):
+                 poll_interval,
+                 use_proxy=True,
+                 label_cache: Dict = None,
+                 parse_workers=2):
         """
         Initializes the class for specific poll interval
-        :param poll_interval: Poll interval
+        :param poll_interval: Base poll interval in minutes. Data older than this is considered stale.
+        :param use_proxy: Crawl through a random proxy
+        :param label_cache: LabelCache keyword arguments, None to not fetch beer labels
+        :param parse_workers: Page parsing processes, 0 to parse on the fetching threads
         """
         self.poll_interval = poll_interval
-        self.stopped = False
+        self.labels = LabelCache(**label_cache) if label_cache is not None else None
 
-        self.crawler = UntappdCrawler()
+        self.crawler = UntappdCrawler(use_proxy, parse_workers)
+        self.scheduler = CrawlScheduler(self.next_refresh_delay, self.refresh)
         self.lists = []
+        self.venues = {}
+        self.opening_hours: Dict[str, OpeningHours] = {}
         self.beer_model = {}
+        self.indexes: Dict[str, BeerIndex] = {}
+        self.updated = {}
+        # List name -> times of the latest requests, appended by the handler threads
+        self.requests: Dict[str, deque] = {}
+        self.requests_lock = Lock()
+        self.listeners: List[Callable[[str, BeerIndex], None]] = []
         self.beer_model_sem = Semaphore(1)
 
     def set_beer_lists(self, lists: Dict):
@@ -197,62 +494,178 @@ class Untappd:
         :param lists: Dictionary containing the list names and URL's
         :return: None
         """
-        self.crawler.set_beer_lists(lists)
+        self.crawler.set_beer_lists({**self.crawler.beer_lists, **lists})
         for key in lists:
-            self.lists.append(key)
+            if key not in self.lists:
+                self.lists.append(key)
+                self.requests[key] = deque(maxlen=256)
+
+    def add_listener(self, listener: Callable[[str, BeerIndex], None]):
+        """
+        Adds a function called with the list name and its new index after each successful refresh
+        :param listener: Listener function
+        :return: None
+        """
+        self.listeners.append(listener)
+
+    def set_venues(self, venues: Dict):
+        """
+        Setup venues and their beer lists
+        :param venues: Dict["Venue name": {"lists": {"List name": "List URL"},
+                                           "opening_hours": {"mon": ("HH:MM", "HH:MM"), ...}}],
+                       venues without opening hours are considered always open
+        :return: None
+        """
+        self.venues = venues
+        for venue in venues.values():
+            self.set_beer_lists(venue["lists"])
+            if "opening_hours" in venue:
+                hours = OpeningHours(venue["opening_hours"])
+                for list in venue["lists"]:
+                    self.opening_hours[list] = hours
+
+    def next_refresh_delay(self, list) -> float:
+        """
+        Delay until the next scheduled refresh of a list, based on its demand during the last hour and the
+        opening hours of its venue
+        :param list: List name
+        :return: Delay in seconds
+        """
+        base = 60 * self.poll_interval
+        hours = self.opening_hours.get(list)
+        if hours is not None:
+            until_open = hours.seconds_until_open(datetime.now())
+            if until_open is None:
+                return base * Untappd.MAX_FACTOR * 24
+            if until_open > 0:
+                return max(base, until_open - Untappd.OPENING_LEAD)
+
+        hour_ago = time() - 3600
+        with self.requests_lock:
+            demand = sum(1 for t in self.requests[list] if t > hour_ago)
+        factor = Untappd.MAX_FACTOR / (1 + demand * (Untappd.MAX_FACTOR - 1) / Untappd.BASE_DEMAND)
+        return base * max(Untappd.MIN_FACTOR, factor)
+
+    def refresh(self, list) -> bool:
+        """
+        Updates one beer list
+        :param list: List name
+        :return: True if succeeded
+        """
+        self.crawler.ensure_proxy()
+        with Metrics.untappd_refresh_duration.time(list):
+            new_model = self.crawler.get_beers_on_list(list)
+        if new_model is None:
+            log.warning("Beer list update failed", extra={"fields": {"list": list}})
+            return False
+
+        index = BeerIndex(new_model)
+        with self.beer_model_sem:
+            self.beer_model[list] = new_model
+            self.indexes[list] = index
+            self.updated[list] = time()
+        log.info("Beer list updated", extra={"fields": {"list": list, "beers": len(new_model)}})
+
+        for listener in self.listeners:
+            try:
+                listener(list, index)
+            except Exception:
+                log.exception("Beer list listener failed", extra={"fields": {"list": list}})
+
+        if self.labels is not None:
+            self.fetch_labels(new_model)
+        return True
+
+    def fetch_labels(self, beers: List[Beer]):
+        """
+        Caches the labels of the given beers, so label replies never have to download anything
+        :param beers: Beers
+        :return: None
+        """
+        urls = {beer.img for beer in beers if beer.img}
+        cached = sum(tpe.map(lambda url: self.labels.fetch(url, self.crawler.get_label), urls))
+        if cached < len(urls):
+            log.warning("Some labels could not be cached", extra={"fields": {"labels": len(urls), "cached": cached}})
 
     def update(self):
         """
         Updates all beer lists
         :return: None
         """
-        print("Updating beer model")
+        log.info("Updating beer model")
         failure = False
         for list in self.lists:
-            new_model = self.crawler.get_beers_on_list(list)
-            if new_model is not None:
-                with self.beer_model_sem:
-                    self.beer_model[list] = new_model
-            else:
+            if not self.refresh(list):
                 failure = True
 
-        print("Beer model update complete with errors!" if failure else "Beer model update complete!")
+        if failure:
+            log.warning("Beer model update complete with errors!")
+        else:
+            log.info("Beer model update complete!")
+
+    def get_index(self, list) -> Optional[BeerIndex]:
+        """
+        Returns the search index of given list. Stale data is returned as is and a background refresh is requested.
+        :param list: Beer list
+        :return: Index, None if the list is not found or not crawled yet
+        """
+        if list not in self.requests:
+            return None
+
+        now = time()
+        with self.requests_lock:
+            self.requests[list].append(now)
+        with self.beer_model_sem:
+            index = self.indexes.get(list)
+            updated = self.updated.get(list, 0)
+
+        if now - updated > 60 * self.poll_interval:
+            self.scheduler.request(list)
+        else:
+            # Demand went up, the next refresh may be due earlier
+            self.scheduler.reschedule(list)
+        return index
 
     def get_beers_on_list(self, list) -> List[Beer]:
         """
-        Returns beers on given list
+        Returns beers on given list. Stale data is returned as is and a background refresh is requested.
         :param list: Beer list
         :return: List of beers, empty list if not found
         """
-        with self.beer_model_sem:
-            if list in self.beer_model:
-                return self.beer_model[list]
-            else:
-                return []
+        index = self.get_index(list)
+        return index.beers if index is not None else []
+
+    def search(self, list, words: List[str]) -> List[Beer]:
+        """
+        Searches beers on given list, see BeerIndex for the query syntax
+        :param list: Beer list
+        :param words: Query words
+        :return: Matching beers, empty list if none or the list is not found
+        """
+        index = self.get_index(list)
+        return index.search(parse_query(words)) if index is not None else []
 
     def poll(self):
         """
         Updates the lists periodically
         :return: None
         """
-        self.stopped = False
-        while not self.stopped:
-            self.update()
-            sleep(60 * self.poll_interval)
+        self.scheduler.run(self.lists)
 
     def start(self):
         """
         Starts polling
         :return: None
         """
-        Thread(target=self.poll).start()
+        Thread(target=self.poll, name="untappd-poll").start()
 
     def stop(self):
         """
         Stops polling
         :return: None
         """
-        self.stopped = True
+        self.scheduler.stop()
+        self.crawler.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Worker processes for CPU bound work.
+
+The bot process is multithreaded, and a forked child inherits the locks other threads happen to hold, so all worker
+processes are started with the spawn method. Spawned workers import the bot's main module, which therefore does
+nothing at import time.
+"""
+
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+import LogUtils
+
+log = LogUtils.get_logger("WorkerPool")
+
+
+def spawn_context():
+    """
+    :return: Multiprocessing context for starting worker processes
+    """
+    return multiprocessing.get_context("spawn")
+
+
+class WorkerPool:
+    """
+    Process pool started on first use. A pool whose worker died is replaced on the next call.
+    """
+
+    def __init__(self, name: str, max_workers: int):
+        """
+        :param name: Pool name for logs
+        :param max_workers: Worker processes
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.executor: Optional[ProcessPoolExecutor] = None
+
+    def run(self, fn: Callable, *args):
+        """
+        Runs a function in a worker process and waits for the result
+        :param fn: Module level function
+        :param args: Picklable arguments
+        :return: Function result
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=spawn_context())
+            executor = self.executor
+        try:
+            return executor.submit(fn, *args).result()
+        except BrokenProcessPool:
+            with self.lock:
+                if self.executor is executor:
+                    log.warning("Worker process died, restarting the pool", extra={"fields": {"pool": self.name}})
+                    self.executor = None
+            raise
+
+    def shutdown(self):
+        """
+        Stops the worker processes
+        :return: None
+        """
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
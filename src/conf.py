@@ -2,21 +2,106 @@
 Configuration is done here
 """
 
-# Snapshot filename
-snapshot_output_file = "snapshot.jpg"
+# Cameras {"Camera name": {"command": "/command", KapinaCam keyword arguments...}}
+# Each camera is captured and processed in its own worker process.
+# Snapshots come in size variants with a JPEG byte budget each, picked by a word after the command (e.g. /kapina hd).
+# The defaults are KapinaCam.DEFAULT_VARIANTS, override with "variants" and "default_variant".
+# camera_id is a device index or path passed to cv2.VideoCapture. A callable returning a capture-like object
+# (with read() and set()) can be given instead, e.g. a synthetic source for benchmarking.
+cameras = {"kapina": {"command": "/kapina",
+                      "camera_id": 0,
+                      "y_crop": (233, 520),
+                      "x_crop": (632, 1042),
+                      "zoom_factor": 2}}
+
+# Telegram bot API base URL, the token is appended to this
+telegram_api_url = "https://api.telegram.org/bot"
+
+# Venues and their Untappd beer lists {"Venue name": {"lists": {"List name": "List URL"}, "opening_hours": {...}}}
+# Each list gets a /<list name> command, so list names must be unique across venues.
+# Lists are only refreshed on demand while the venue is closed. Leave opening_hours out for always open venues.
+venues = {"kapina": {"lists": {"hana": "https://untappd.com/v/pub-kultainen-apina/17995?ng_menu_id=5035026b-1470-48c7"
+                                       "-b82a-bf1df18f5889"},
+                     "opening_hours": {"mon": ("14:00", "02:00"),
+                                       "tue": ("14:00", "02:00"),
+                                       "wed": ("14:00", "02:00"),
+                                       "thu": ("14:00", "02:00"),
+                                       "fri": ("14:00", "03:00"),
+                                       "sat": ("12:00", "03:00"),
+                                       "sun": ("14:00", "02:00")}}}
+
+# Base Untappd refresh interval in minutes. The actual interval adapts to how often the lists are requested,
+# and refreshes of different lists are spread over it. Data older than this is refreshed when requested.
+untappd_poll_interval = 5
+
+# Crawl Untappd through random proxies to avoid getting IP blocked
+untappd_use_proxy = True
+
+# Processes parsing Untappd pages, 0 to parse on the fetching threads of the bot process
+untappd_parse_workers = 2
+
+# Beer label thumbnails for "/<list> labels" replies, fetched during the crawl and kept in a bounded cache.
+# LabelCache keyword arguments, None to disable.
+label_cache = {"directory": "assets/labels",
+               "max_entries": 500,
+               "memory_entries": 100,
+               "size": 320}
+
+# Word after a list command asking for the label album reply
+beer_labels_keyword = "labels"
+
+# Seconds Telegram may cache inline query answers (@bot ipa), shorter when the answer includes a camera snapshot.
+# Inline mode has to be enabled for the bot with BotFather.
+inline_cache_time = 300
+inline_snapshot_cache_time = 15
 
 # This is built dynamically later on when the bot is initialized
 beer_tap_triggers = []
 
 # Command triggers
-triggers = {"image": "/kapina",
-            "help": "/help",
-            "drink_records": "/kaljat"}
+triggers = {"help": "/help",
+            "drink_records": "/kaljat",
+            "leaderboard": "/top",
+            "streak": "/streak",
+            "hours": "/hours",
+            "profile": "/profile"}
 
 blacklist = {
     "vulstars": "/kilju"
 }
 
+# Telegram user ids allowed to run admin commands, e.g. /profile
+admins = []
+
+
+# Chat that drinks logged before drink records were kept per chat are assigned to. Required to upgrade a database
+# with such records, the drink commands are unavailable until it is set. See "Upgrading" in the README.
+drinkstats_legacy_chat_id = None
 
 # Thread pool size for smooth handling of multiple requests
 pool_size = 10
+
+# Log levels per module, modules not listed here log at INFO
+log_levels = {"KapinaBot": "INFO",
+              "Networking": "INFO",
+              "UntappdUtils": "INFO",
+              "KapinaCam": "INFO",
+              "DrinkTrackerUtils": "INFO",
+              "TelegramUtils": "WARNING",
+              "Services": "INFO"}
+
+# Only every Nth record of noisy log messages is written
+log_sampling = {"proxy_attempt": 20}
+
+# Local port for the Prometheus style /metrics endpoint, None to disable
+metrics_port = 9108
+
+# Profiling time of /profile and the /debug/profile endpoint, e.g. "/profile 30" or /debug/profile?seconds=30
+profile_default_seconds = 10
+profile_max_seconds = 60
+
+# Local overrides, e.g. for running against fake backends
+try:
+    from conf_local import *
+except ImportError:
+    pass